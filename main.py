@@ -1,4 +1,5 @@
 from scripts.UI import run_ui
+from scripts.logger import VLCync_Logger
 from scripts.config_handler import ClsConfigParser
 from scripts.cli_connector import ClsCliConnector
 from scripts.module_factory import ClsModuleFactory
@@ -6,6 +7,7 @@ from scripts.module_factory import ClsModuleFactory
 
 def main():
     with ClsConfigParser() as config:
+        VLCync_Logger.configure(config)
         with ClsCliConnector(config) as connection_handler:
             playerUtil = ClsModuleFactory.get_module(
                 config, connection_handler
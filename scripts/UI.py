@@ -1,19 +1,35 @@
 import os
-from threading import Thread
+from threading import Thread, Event, Lock
+from time import perf_counter
 
 from ui.UI_VLCync import Ui_VLCync
 from PyQt5 import QtGui
 from PyQt5.QtWidgets import QApplication, QMainWindow, QFileDialog
 from PyQt5.QtCore import pyqtSignal
 
-from scripts.hash import getHash
+from scripts.hash import (
+    getHash, BLOCKSIZE, HashCancelled, ALGORITHMS, ALGORITHM_IDS,
+    rank_algorithms, pick_algorithm
+)
+from scripts.hash_cache import ClsHashCache
+from scripts.verifier import ClsStagedVerifier
 from scripts.logger import VLCync_Logger
+from scripts.protocol import ClsDispatcher, Opcode
 from scripts.common_toolkit import ClsCommonToolkit as CTK
 
 
 class MainWindow(QMainWindow):
     consoleSignal = pyqtSignal()
     msgSignal = pyqtSignal(str, str)
+    # path, bytes done, total bytes, MiB/s
+    hashProgressSignal = pyqtSignal(str, int, int, float)
+    hashDoneSignal = pyqtSignal(str, str)
+    hashErrorSignal = pyqtSignal(str, str)
+    # username, stage that differed
+    verifyMismatchSignal = pyqtSignal(str, int)
+    algorithmChangedSignal = pyqtSignal(str)
+    # Seconds between progress updates sent to the lobby screen
+    HASH_PROGRESS_INTERVAL = 0.1
     hashesMatch = False
     isFileSelected = False
     hasVoted = False
@@ -25,18 +41,44 @@ class MainWindow(QMainWindow):
         self.config = config
         self.connection_handler = connection_handler
         self.playerUtil = playerUtil
+        self.hashingFile = None
+        self.hashCancel = None
+        self.verifier = ClsStagedVerifier()
+        # Announced hash algorithm rankings, for hashalgo=auto, and the
+        # algorithm they picked for the last hash started
+        self.peerRankings = {}
+        self.hashAlgo = None
+        # Kept next to config.ini
+        self.hashCache = ClsHashCache(
+            os.path.dirname(os.path.abspath(config.configFileName)),
+            config.get_value(
+                "default", "hashcachesize", ClsHashCache.MAX_ENTRIES
+            )
+        )
+
+        self.dispatcher = ClsDispatcher(self.chatMessage)
+        self.dispatcher.register(Opcode.HASH_MATCH, self.hashesMatched)
+        self.dispatcher.register(Opcode.HASH_MISMATCH, self.hashesMismatched)
+        self.dispatcher.register(Opcode.HASH_RESET, self.hashesReset)
+        self.dispatcher.register(Opcode.ALL_VOTED, self.everyoneVoted)
+        self.dispatcher.register(Opcode.VERIFY, self.verifyReceived)
+        self.dispatcher.register(Opcode.HASH_RANK, self.rankingReceived)
+        self.playerUtil.register_handlers(self.dispatcher)
         # self.ignoreHash = self.config.getValue("default", "ignorehash")
 
         self.ui = Ui_VLCync()
         self.ui.setupUi(self)
 
-        self.receptionThread = None
-
         self.toPg1()
         self.ui.liveConsoleOutput.setText("")
 
         self.consoleSignal.connect(self.unintentionalDC)
         self.msgSignal.connect(self.dispMessage)
+        self.hashProgressSignal.connect(self.showHashProgress)
+        self.hashDoneSignal.connect(self.hashCompleted)
+        self.hashErrorSignal.connect(self.hashFailed)
+        self.verifyMismatchSignal.connect(self.verifyMismatch)
+        self.algorithmChangedSignal.connect(self.algorithmChanged)
 
         self.ui.inp_username.setText(self.connection_handler.def_usn)
         self.ui.inp_ip.setText(self.connection_handler.defaultAddr())
@@ -52,17 +94,24 @@ class MainWindow(QMainWindow):
         self.ui.label_output.setText("")
 
         self.ui.stackedWidget.setCurrentWidget(self.ui.lobbyScreen)
-        self.receptionThread = Thread(target=self.receiver)
-        self.receptionThread.start()
+        self.safeDC = False
+        self.connection_handler.listen(
+            self.receiver, self.connectionLost,
+            self.connectionInterrupted, self.connectionResumed
+        )
+        if self.hashAlgorithm() == "auto":
+            self.announceRanking()
 
     def toPg1(self):
+        if self.hashCancel is not None:
+            self.hashCancel.set()
+        self.hashingFile = None
+        self.peerRankings.clear()
+        self.hashAlgo = None
         self.ui.liveConsoleOutput.setText("")
         self.ui.fileNameDisplay.setText("")
         self.hasVoted = False
         self.ui.voteButton.setText("Vote to start")
-
-        if self.receptionThread is not None and self.receptionThread.is_alive():
-            self.receptionThread.join()
         self.ui.stackedWidget.setCurrentWidget(self.ui.loginScreen)        
 
     def connectToServer(self):
@@ -77,9 +126,9 @@ class MainWindow(QMainWindow):
             addr, port = CTK.split_addr(self.ui.inp_ip.text())
             self.logger.info(f"Attempting connection with {addr}:{port} as {usn}")
             self.connection_handler.setKey(self.ui.inp_password.text())
-            name, msg, _ = self.connection_handler.connect(addr, int(port), usn)
+            packet = self.connection_handler.connect(addr, int(port), usn)
 
-            self.dispMessage(name, msg)
+            self.dispMessage(packet.username, packet.message)
 
             if self.connection_handler.isConnected:
                 self.toPg2()
@@ -90,35 +139,32 @@ class MainWindow(QMainWindow):
             self.logger.exception(str(e))
             self.ui.label_output.setText(f"<font color=red>{str(e)}</font>")
 
-    def receiver(self):
-        while self.connection_handler.isConnected:
-            try: 
-                stream = self.connection_handler.receive()
-                if stream is True:
-                    continue
-                if stream is False:
-                    self.consoleSignal.emit()
-                    break
-
-                name, msg, forVLC = stream
-                self.logger.info(f"Received => {name}: {msg}")
-                if forVLC:
-                    self.playerUtil.outsideInput(msg)
-                
-                else:
-                    self.msgParser(name, msg)
-            
-            except Exception as e:
-                self.logger.exception(e)
-                return e
-        
+    def receiver(self, packet):
+        try:
+            self.logger.info(
+                f"Received => {packet.username}: {packet.message}"
+            )
+            self.dispatcher.dispatch(packet)
+
+        except Exception as e:
+            self.logger.exception(e)
+
+    def connectionLost(self):
         if not self.safeDC:
             self.consoleSignal.emit()
 
+    def connectionInterrupted(self):
+        self.msgSignal.emit("CLIENT", "Connection lost, reconnecting...")
+
+    def connectionResumed(self, packet):
+        self.msgSignal.emit("CLIENT", "Reconnected")
+        if self.playerUtil.playback:
+            self.playerUtil.update_resume_point()
+
     def dispMessage(self, name, msg):
         old = self.ui.liveConsoleOutput.text()
         new = f"<font color=#04cc72>{name}</font>: <font color=#ddd>{msg}</font><br>"
-        self.logger.debug(f"Wrote to liveConsole -> {name}:{msg}")
+        self.logger.debug("Wrote to liveConsole -> %s:%s", name, msg)
         # if not len(old):
         #     self.ui.liveConsoleOutput.setText(f"{new}")
         self.ui.liveConsoleOutput.setText(f"{old}{new}")
@@ -147,34 +193,236 @@ class MainWindow(QMainWindow):
     def selectMedia(self):
         file_addr = QFileDialog.getOpenFileName()[0]
         # self.logger.debug(f"{file_addr.split('/')}, {type(file_addr.split('/'))}")
+        if not len(file_addr):
+            return
+
         if os.name=="nt":
             file_addr = file_addr.replace('/', "\\")
+
+        self.startHashing(file_addr)
+        # VLC starts up while the file is being hashed
+        self.playerUtil.prepare(file_addr)
+
+    def startHashing(self, file_addr):
+        # A newer pick supersedes whatever is still being hashed
+        if self.hashCancel is not None:
+            self.hashCancel.set()
+        self.hashingFile = file_addr
+        self.hashCancel = Event()
+        self.isFileSelected = False
+        self.ui.fileNameDisplay.setText(f"Hashing {file_addr}")
+        staged = (
+            "VERIFY" in self.connection_handler.capabilities and
+            self.config.get_value("default", "verify", "staged") == "staged"
+        )
+        Thread(
+            target=self.hashWorker,
+            args=(file_addr, self.hashCancel, staged), daemon=True
+        ).start()
+
+    def hashWorker(self, file_addr, cancel, staged=False):
+        algo = self.hashAlgorithm()
+        if algo == "auto":
+            algo = self.pickAlgorithm()
+            self.hashAlgo = algo
+            self.logger.info(f"Hashing with {algo}, fastest for all peers")
+        on_chunk = None
+        start = perf_counter()
+        state = {"done": 0, "shown": start}
+        lock = Lock()
+
+        def progress(read):
+            with lock:
+                state["done"] += read
+                now = perf_counter()
+                if now - state["shown"] < self.HASH_PROGRESS_INTERVAL:
+                    return
+                state["shown"] = now
+                done = state["done"]
+
+            self.hashProgressSignal.emit(
+                file_addr, done, total, done / 2**20 / (now - start)
+            )
+
         try:
-            file_hash = getHash(file_addr)
-            self.logger.debug(f"{file_addr} -> {file_hash}")
+            total = os.path.getsize(file_addr)
+            if staged:
+                # Size and the sampled fingerprint go out at once, chunk
+                # digests follow as the full hash gets through the file.
+                # The hash announced to the server stays the configured
+                # one, so peers not verifying in stages still match
+                self.verifier.reset()
+                self.announceStage(ClsStagedVerifier.SIZE, total, cancel)
+                self.announceStage(
+                    ClsStagedVerifier.SAMPLE,
+                    ClsStagedVerifier.fold(
+                        getHash(file_addr, "sample", cancel=cancel)
+                    ), cancel
+                )
+                on_chunk = lambda index, digest: self.announceStage(
+                    ClsStagedVerifier.FIRST_CHUNK + index,
+                    ClsStagedVerifier.fold(digest), cancel
+                )
+
+            file_hash = self.hashCache.get_hash(
+                file_addr, algo,
+                int(self.config.get_value(
+                    "default", "hashblocksize", BLOCKSIZE
+                )),
+                progress=progress, cancel=cancel, on_chunk=on_chunk
+            )
+
+        except HashCancelled:
+            self.logger.debug(f"Cancelled hashing {file_addr}")
+            return
+
         except Exception as e:
             self.logger.exception(str(e))
-            self.ui.fileNameDisplay.setText(str(e))
+            self.hashErrorSignal.emit(file_addr, str(e))
+            return
+
+        self.logger.debug(
+            f"{file_addr} -> {file_hash} in {perf_counter() - start:.2f}s"
+        )
+        if not cancel.is_set():
+            self.hashDoneSignal.emit(file_addr, file_hash)
+
+    def hashAlgorithm(self):
+        # Older servers relay HASH_RANK as chat, so every peer would pick
+        # alone. auto then falls back to the default all peers share
+        algo = self.config.get_value("default", "hashalgo", "crc32")
+        if (
+            algo == "auto" and
+            "RANK" not in self.connection_handler.capabilities
+        ):
+            return "crc32"
+        return algo
+
+    def localRanking(self):
+        # Peers with a fixed algorithm announce just that one, which steers
+        # the peers on auto towards it. Rankings have no way to name the
+        # tree or sample modes, so those announce nothing
+        algo = self.config.get_value("default", "hashalgo", "crc32")
+        if algo == "auto":
+            return rank_algorithms()
+
+        return [algo] if algo in ALGORITHMS else []
+
+    def pickAlgorithm(self):
+        return pick_algorithm(
+            [rank_algorithms(), *list(self.peerRankings.values())]
+        )
+
+    def announceRanking(self):
+        # Timing the algorithms takes a moment, keep it off the Qt thread
+        def announce():
+            ranking = self.localRanking()
+            if len(ranking):
+                self.connection_handler.send_command(
+                    Opcode.HASH_RANK,
+                    *(ALGORITHM_IDS.index(algo) for algo in ranking)
+                )
+
+        Thread(target=announce, daemon=True).start()
+
+    def rankingReceived(self, packet, *ids):
+        # A peer we have not heard from yet has not heard from us either
+        if packet.username not in self.peerRankings:
+            self.announceRanking()
+
+        self.peerRankings[packet.username] = [
+            ALGORITHM_IDS[index] for index in ids
+            if 0 <= index < len(ALGORITHM_IDS)
+        ]
+
+        # Our file was hashed before this peer's ranking was known, the
+        # pick may have moved
+        if self.hashAlgo is not None:
+            def repick():
+                algo = self.pickAlgorithm()
+                if algo != self.hashAlgo:
+                    self.algorithmChangedSignal.emit(algo)
+
+            Thread(target=repick, daemon=True).start()
+
+    def algorithmChanged(self, algo):
+        if algo == self.hashAlgo:
+            return
+
+        file_addr = self.hashingFile
+        if file_addr is None and self.isFileSelected:
+            file_addr = self.file_path
+        if file_addr is None:
+            return
+
+        self.logger.info(f"Peers now settle on {algo}, rehashing")
+        self.hashAlgo = algo
+        self.startHashing(file_addr)
+
+    def announceStage(self, stage, value, cancel):
+        if cancel.is_set():
+            raise HashCancelled()
+
+        self.connection_handler.send_command(Opcode.VERIFY, stage, value)
+        for username in self.verifier.add_local(stage, value):
+            self.verifyMismatchSignal.emit(username, stage)
+
+    def verifyReceived(self, packet, stage, value):
+        if self.verifier.add_peer(packet.username, stage, value):
+            self.verifyMismatchSignal.emit(packet.username, stage)
+
+    def verifyMismatch(self, username, stage):
+        what = {
+            ClsStagedVerifier.SIZE: "size",
+            ClsStagedVerifier.SAMPLE: "sampled fingerprint"
+        }.get(stage, f"chunk {stage - ClsStagedVerifier.FIRST_CHUNK}")
+        # Only a warning, the hash still runs to the end. The peer may
+        # re-pick or leave, and the others need our full hash either way
+        self.dispMessage(
+            "CLIENT", f"{username} selected a different file ({what} differs)"
+        )
+
+    def showHashProgress(self, file_addr, done, total, rate):
+        if file_addr != self.hashingFile:
             return
 
+        self.ui.fileNameDisplay.setText(
+            f"Hashing {os.path.basename(file_addr)}: "
+            f"{done * 100 // max(total, 1)}% ({rate:.0f} MiB/s)"
+        )
+
+    def hashCompleted(self, file_addr, file_hash):
+        if file_addr != self.hashingFile:
+            return
+
+        self.hashingFile = None
         self.logger.info(f"Selected {file_addr}")
         self.dispMessage("You", f"Selected {file_addr}")
         self.file_path = file_addr
         self.ui.fileNameDisplay.setText(file_addr)
         self.isFileSelected = True
-        self.connection_handler.send(f"SELECTED FILE HASH={file_hash}", False)
+        self.connection_handler.send(
+            f"SELECTED FILE HASH={file_hash}", False, resume="hash"
+        )
+
+    def hashFailed(self, file_addr, error):
+        if file_addr != self.hashingFile:
+            return
+
+        self.hashingFile = None
+        self.ui.fileNameDisplay.setText(error)
 
     def voteToggle(self):
         if self.isFileSelected and self.hashesMatch and not self.hasVoted:
             self.hasVoted = True
-            self.connection_handler.send("VOTE", False)
+            self.connection_handler.send_command(Opcode.VOTE)
             self.logger.info("Voted notified")
             self.ui.voteButton.setText("Unvote")
             return
 
         if self.hasVoted:
             self.hasVoted = False
-            self.connection_handler.send("UNVOTE", False)
+            self.connection_handler.send_command(Opcode.UNVOTE)
             self.logger.info("Vote withdrawal notified")
             self.ui.voteButton.setText("Vote to start")
             return
@@ -187,26 +435,21 @@ class MainWindow(QMainWindow):
         self.logger.info("Attempted vote without selecting file")
         self.dispMessage("CLIENT", "Please select a file before voting")
 
-    def msgParser(self, name, msg):
-        if msg.isupper():
-            if "HASHES MATCH" in msg:
-                self.msgSignal.emit(name, "Files match!")
-                self.hashesMatch = True
-                return
+    def chatMessage(self, packet):
+        self.msgSignal.emit(packet.username, packet.message)
 
-            if "HASHES DO NOT MATCH" in msg:
-                self.msgSignal.emit(name, "Files do not match")
-                return
+    def hashesMatched(self, packet):
+        self.msgSignal.emit(packet.username, "Files match!")
+        self.hashesMatch = True
 
-            if "HASH BOOL RESET" in msg:
-                self.hashesMatch = False
-                return
+    def hashesMismatched(self, packet):
+        self.msgSignal.emit(packet.username, "Files do not match")
 
-            if "EVERYONE HAS VOTED" in msg:
-                self.playerUtil.beginPlayback(self.file_path)
-                return
+    def hashesReset(self, packet):
+        self.hashesMatch = False
 
-        self.msgSignal.emit(name, msg)        
+    def everyoneVoted(self, packet):
+        self.playerUtil.begin_playback(self.file_path)
 
 
 def run_ui(config, connection_handler, playerUtil):
@@ -0,0 +1,391 @@
+import os
+import sys
+import random
+import pickle
+import logging
+import itertools
+import tempfile
+import subprocess
+from timeit import timeit
+from time import sleep, perf_counter, process_time, thread_time
+
+from scripts.com_packet import CommPacket, WIRE_LENGTH
+from scripts.protocol import Opcode
+from scripts.vlc_status import ClsStatusReader
+from scripts.drift_control import ClsDriftController
+from scripts.fake_vlc import ClsFakeVLC
+from scripts.hash import getHash, BLOCKSIZE, ALGORITHMS, rank_algorithms
+
+# nonce + tag added by ClsEncryptTool in front of every payload
+CIPHER_OVERHEAD = 32
+LEGACY_HEADER_SIZE = 10
+
+
+def bench_wire(iterations=100000):
+    iterations = int(iterations)
+    samples = {
+        "seek": ("new_user", "seek 5423", True, int(Opcode.SEEK), (5423000,)),
+        "pause": ("new_user", "toggle_play", True, int(Opcode.PAUSE)),
+        "chat": ("new_user", "anyone else hearing the audio lag?", False),
+        "hash": ("new_user", "SELECTED FILE HASH=6F1C02AB", False)
+    }
+
+    print(
+        f"{'message':<8} {'format':<7} {'encode us':>10} {'decode us':>10} "
+        f"{'bytes on wire':>14}"
+    )
+    for name, pack in samples.items():
+        pickled = pickle.dumps(CommPacket.create_packet(*pack))
+        binary = CommPacket.encode(pack)
+        rows = {
+            "pickle": (
+                lambda: pickle.dumps(CommPacket.create_packet(*pack)),
+                lambda: CommPacket.unravel_packet(pickle.loads(pickled)),
+                len(pickled) + CIPHER_OVERHEAD + LEGACY_HEADER_SIZE
+            ),
+            "binary": (
+                lambda: CommPacket.encode(pack),
+                lambda: CommPacket.decode(binary),
+                len(binary) + CIPHER_OVERHEAD + WIRE_LENGTH.size
+            )
+        }
+        for fmt, (encode, decode, size) in rows.items():
+            enc_us = timeit(encode, number=iterations) / iterations * 1e6
+            dec_us = timeit(decode, number=iterations) / iterations * 1e6
+            print(
+                f"{name:<8} {fmt:<7} {enc_us:>10.3f} {dec_us:>10.3f} "
+                f"{size:>14}"
+            )
+
+
+def sample_status_xml(streams=2, tags=10):
+    meta = "".join(
+        f"<info name='tag_{i}'>value {i}</info>" for i in range(tags)
+    )
+    stream_info = "".join(
+        f"<category name='Stream {i}'><info name='Codec'>H264 - MPEG-4 AVC"
+        f"</info><info name='Language'>English</info><info name='Type'>"
+        f"Video</info><info name='Frame rate'>23.976024</info></category>"
+        for i in range(streams)
+    )
+    return (
+        "<?xml version=\"1.0\" encoding=\"utf-8\" standalone=\"yes\" ?>"
+        "<root><fullscreen>false</fullscreen><aspectratio>default"
+        "</aspectratio><audiodelay>0</audiodelay><apiversion>3</apiversion>"
+        "<currentplid>4</currentplid><time>1234</time><volume>256</volume>"
+        "<length>7260</length><random>false</random><audiofilters>"
+        "<filter_0></filter_0></audiofilters><rate>1</rate><videoeffects>"
+        "<hue>0</hue><saturation>1</saturation><contrast>1</contrast>"
+        "<brightness>1</brightness><gamma>1</gamma></videoeffects>"
+        "<state>playing</state><loop>false</loop><version>3.0.18 Vetinari"
+        "</version><position>0.16997246444225</position><repeat>false"
+        "</repeat><subtitledelay>0</subtitledelay><equalizer></equalizer>"
+        f"<information><category name='meta'>{meta}</category>{stream_info}"
+        "</information><stats><inputbitrate>0</inputbitrate></stats></root>"
+    ).encode('utf-8')
+
+
+def bench_status(iterations=5000):
+    from xmltodict import parse
+
+    iterations = int(iterations)
+    print(f"{'streams':>7} {'tags':>5} {'xmltodict us':>13} {'reader us':>10}")
+    for streams, tags in ((2, 10), (8, 40), (32, 200)):
+        xml = sample_status_xml(streams, tags)
+        full_us = timeit(
+            lambda: parse(xml).get("root", {}), number=iterations
+        ) / iterations * 1e6
+        reader_us = timeit(
+            lambda: ClsStatusReader.parse(xml), number=iterations
+        ) / iterations * 1e6
+        print(f"{streams:>7} {tags:>5} {full_us:>13.1f} {reader_us:>10.1f}")
+
+
+def bench_drift(initial_drift=1.0, beacon_interval=5, step=0.05):
+    # Simulated clock: one peer starts initial_drift seconds off a reference
+    # playing at 1x and only corrects when a beacon arrives
+    controller = ClsDriftController()
+    drift = float(initial_drift)
+    beacon_interval = float(beacon_interval)
+    step = float(step)
+    rate = 1.0
+    clock = 0.0
+    next_beacon = 0.0
+
+    print(f"{'t (s)':>7} {'drift (s)':>10} {'rate':>6}")
+    while clock < 600:
+        if clock >= next_beacon:
+            rate = controller.update(drift)
+            if rate is None:
+                print(f"{clock:>7.1f} {drift:>10.3f}   seek")
+                drift, rate = 0.0, 1.0
+
+            print(f"{clock:>7.1f} {drift:>10.3f} {rate:>6.3f}")
+            if abs(drift) <= controller.DEADBAND:
+                print(f"Converged after {clock:.1f}s")
+                return clock
+            next_beacon += beacon_interval
+
+        drift += (rate - 1.0) * step
+        clock += step
+
+    print("Did not converge")
+
+
+class _BenchConfig:
+    header_size = 10
+
+    def get_value(self, section, option, default=None):
+        return default if default is not None else ""
+
+
+class _BenchConnection:
+    capabilities = {}
+
+    def send_command(self, opcode, *args):
+        pass
+
+    def disconnect(self):
+        pass
+
+
+def _percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def _player_module(fake):
+    from scripts.http_module_util import HTTPmodule
+
+    player = HTTPmodule(_BenchConfig(), _BenchConnection())
+    player.TARG_ADDR, player.TARG_PORT = fake.address
+    player.session_token = "bench"
+    player._open_session()
+    return player
+
+
+def _until(player, done):
+    start = perf_counter()
+    while not done(player._vlc_transceiver()):
+        pass
+    return perf_counter() - start
+
+
+def bench_player(iterations=200, latency=0.0, jitter=0.0):
+    # Drives the HTTP module's transport against the fake VLC, the actor
+    # thread stays idle since playback is never started through it
+    iterations = int(iterations)
+    with ClsFakeVLC(latency=float(latency), jitter=float(jitter)) as fake:
+        player = _player_module(fake)
+        player._vlc_transceiver("begin", path="sample.mkv")
+        player._vlc_transceiver("play")
+
+        wall, cpu = perf_counter(), thread_time()
+        for _ in range(iterations):
+            player._vlc_transceiver()
+        wall = (perf_counter() - wall) / iterations * 1e6
+        cpu = (thread_time() - cpu) / iterations * 1e6
+
+        seeks = []
+        for _ in range(iterations // 10 or 1):
+            target = random.randint(0, fake.media.length - 10)
+            start = perf_counter()
+            player._vlc_transceiver("seek", val=target)
+            seeks.append(perf_counter() - start + _until(
+                player, lambda status: abs(status["time"] - target) <= 1
+            ))
+
+        toggles = []
+        for _ in range(iterations // 10 or 1):
+            expected = "paused" if fake.media.state == "playing" else "playing"
+            start = perf_counter()
+            player._vlc_transceiver("toggle_play")
+            toggles.append(perf_counter() - start + _until(
+                player, lambda status: status["state"] == expected
+            ))
+
+        player._close_transport()
+
+    print(f"poll: {wall:.1f} us wall, {cpu:.1f} us client CPU")
+    print(f"{'command':<8} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8}")
+    for name, samples in (("seek", seeks), ("toggle", toggles)):
+        print(
+            f"{name:<8} {_percentile(samples, 50) * 1000:>8.2f} "
+            f"{_percentile(samples, 95) * 1000:>8.2f} "
+            f"{max(samples) * 1000:>8.2f}"
+        )
+
+
+def _start_server(key):
+    server = subprocess.Popen(
+        [sys.executable, "-m", "scripts.fake_server", key],
+        stdout=subprocess.PIPE, text=True
+    )
+    host, _, port = server.stdout.readline().split()[-1].rpartition(":")
+    return server, host, int(port)
+
+
+def bench_lobby(clients=12, storms=50, burst=5, gap=0.02):
+    # N headless connectors against the fake server in its own process, so
+    # the CPU measured here is the client stack's. Every injected command
+    # carries a unique id in its argument, which ties each delivery back to
+    # its send time
+    from scripts.cli_connector import ClsCliConnector
+
+    clients, storms, burst, gap = int(clients), int(storms), int(burst), \
+        float(gap)
+    key = "bench"
+    server, host, port = _start_server(key)
+    sent_at = {}
+    latencies = {}
+    ids = itertools.count()
+
+    def on_packet(packet):
+        if packet.opcode in (Opcode.SEEK, Opcode.PAUSE):
+            latencies.setdefault(packet.args[0], []).append(
+                perf_counter() - sent_at[packet.args[0]]
+            )
+
+    try:
+        connectors = [ClsCliConnector(_BenchConfig()) for _ in range(clients)]
+        logging.getLogger('VLCync').setLevel(logging.WARNING)
+        for number, connector in enumerate(connectors):
+            connector.setKey(key)
+            connector.connect(host, port, f"client{number}")
+            connector.listen(on_packet)
+            connector.send("SELECTED FILE HASH=BENCH", False, resume="hash")
+
+        wall, cpu = perf_counter(), process_time()
+        for storm in range(storms):
+            connector = random.choice(connectors)
+            for _ in range(burst):
+                opcode = random.choice((Opcode.SEEK, Opcode.PAUSE))
+                command = next(ids)
+                sent_at[command] = perf_counter()
+                connector.send_command(opcode, command)
+            sleep(gap)
+
+        # Coalesced seeks never arrive, so wait for deliveries to settle
+        delivered = -1
+        while delivered != sum(len(times) for times in latencies.values()):
+            delivered = sum(len(times) for times in latencies.values())
+            sleep(0.2)
+        wall, cpu = perf_counter() - wall, process_time() - cpu
+
+        for connector in connectors:
+            connector.disconnect()
+
+    finally:
+        server.terminate()
+        server.wait()
+
+    samples = [time for times in latencies.values() for time in times]
+    print(
+        f"{clients} clients, {len(sent_at)} commands, "
+        f"{len(sent_at) - len(latencies)} coalesced before sending, "
+        f"{len(samples)}/{len(latencies) * (clients - 1)} deliveries"
+    )
+    if len(samples):
+        print(f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+        print(
+            f"{_percentile(samples, 50) * 1000:>8.2f} "
+            f"{_percentile(samples, 95) * 1000:>8.2f} "
+            f"{_percentile(samples, 99) * 1000:>8.2f} "
+            f"{max(samples) * 1000:>8.2f}"
+        )
+    print(
+        f"client CPU: {cpu / wall * 100:.1f}% of a core, "
+        f"{cpu / max(1, len(samples)) * 1e6:.1f} us per delivery"
+    )
+
+
+def _sample_media(size_gb):
+    # Random data so no layer can shortcut runs of zeros, written in large
+    # repeated blocks to keep creating a multi-GB file quick
+    block = random.randbytes(2**26)
+    media = tempfile.NamedTemporaryFile(suffix=".mkv", delete=False)
+    with media:
+        for _ in range(int(float(size_gb) * 2**30) // len(block)):
+            media.write(block)
+    return media.name
+
+
+def bench_hash(path=None, size_gb=2, block_size=BLOCKSIZE):
+    # Reads are served from the page cache after the first pass unless
+    # the file is larger than RAM, so the first row includes the disk
+    block_size = int(block_size)
+    sample = path is None or path == "-"
+    if sample:
+        path = _sample_media(size_gb)
+    size = os.path.getsize(path)
+
+    try:
+        print(f"{size / 2**30:.2f} GiB, {block_size // 1024} KiB blocks")
+        print(f"{'algorithm':<12} {'seconds':>8} {'MiB/s':>8}")
+        for algo in (
+            "crc32", "crc32-tree", "sha256", "sha256-tree", "sample"
+        ):
+            start = perf_counter()
+            getHash(path, algo, block_size)
+            elapsed = perf_counter() - start
+            print(f"{algo:<12} {elapsed:>8.2f} {size / 2**20 / elapsed:>8.0f}")
+
+    finally:
+        if sample:
+            os.remove(path)
+
+
+def bench_algos(path=None, size_gb=1, *block_sizes):
+    # MiB/s of every algorithm at each block size on the given file. One
+    # untimed pass first, so every row reads from the page cache alike
+    block_sizes = [int(size) for size in block_sizes] or [
+        2**16, 2**18, 2**20, 2**22
+    ]
+    sample = path is None or path == "-"
+    if sample:
+        path = _sample_media(size_gb)
+    size = os.path.getsize(path)
+
+    try:
+        getHash(path, "adler32")
+        print(f"{size / 2**30:.2f} GiB, MiB/s by block size")
+        print(f"{'algorithm':<10}" + "".join(
+            f"{f'{block // 1024} KiB':>10}" for block in block_sizes
+        ))
+        for algo in ALGORITHMS:
+            row = f"{algo:<10}"
+            for block in block_sizes:
+                start = perf_counter()
+                getHash(path, algo, block)
+                row += f"{size / 2**20 / (perf_counter() - start):>10.0f}"
+            print(row)
+
+        print(f"auto ranking: {', '.join(rank_algorithms())}")
+
+    finally:
+        if sample:
+            os.remove(path)
+
+
+BENCHMARKS = {
+    "wire": bench_wire,
+    "status": bench_status,
+    "drift": bench_drift,
+    "player": bench_player,
+    "lobby": bench_lobby,
+    "hash": bench_hash,
+    "algos": bench_algos
+}
+
+
+def main(argv):
+    if not len(argv) or argv[0] not in BENCHMARKS:
+        print(f"Usage: python -m scripts.bench {{{'|'.join(BENCHMARKS)}}} ...")
+        return 1
+
+    BENCHMARKS[argv[0]](*argv[1:])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,27 +1,71 @@
 import errno
 import socket
+import random
+import itertools
+import selectors
+from collections import deque
+from threading import Thread, Condition, Event, current_thread
 
-from scripts.com_packet import CommPacket
+from scripts.com_packet import CommPacket, WIRE_VERSIONS
+from scripts.frame_reader import ClsFrameReader
+from scripts.protocol import Opcode, to_text, is_for_vlc
+from scripts.clock_sync import ClsClockSync
 from scripts.logger import VLCync_Logger
 from scripts.encryption import ClsEncryptTool
 
 
 class ClsCliConnector:
+    CONNECT_TIMEOUT = 5
+    HANDSHAKE_TIMEOUT = 10
+    RECEIVE_TIMEOUT = 0.5
+    SEND_TIMEOUT = 2
+    SEND_QUEUE_SIZE = 64
+    # Only the newest of these is worth sending, queued ones get replaced
+    COALESCED = (Opcode.SEEK, Opcode.CURRTIME)
+    RECONNECT_ATTEMPTS = 8
+    RECONNECT_BASE_DELAY = 0.5
+    RECONNECT_MAX_DELAY = 15
+    # Clock probes are sent in a quick burst, then kept up at a slow pace
+    CLOCK_PROBE_BURST = 4
+    CLOCK_PROBE_SPACING = 0.5
+    CLOCK_SYNC_INTERVAL = 20
+
     def __init__(self, config):
-        self.logger = VLCync_Logger.get_logger('Client')
+        self.logger = VLCync_Logger.get_logger('Network')
         self.config = config
         # self.codec = ClsEncryptTool(key)
         self.isConnected = False
+        self.isReconnecting = False
+        self.selector = None
+        self.listenerThread = None
+        self.writerThread = None
+        self.frameReader = None
+        self._backlog = deque()
+        self._outbox = deque()
+        self._outboxCond = Condition()
+        self._writerStop = False
+        self._closing = Event()
+        # Lobby state replayed to the server after a reconnect
+        self.resumeState = {}
+        self.capabilities = {}
+        self.clock = ClsClockSync()
+        self.clockThread = None
+        self._lastReceiveMs = None
+        self._seq = itertools.count(1)
+
+        self.reconnectAttempts = int(config.get_value(
+            "default", "reconnectattempts", self.RECONNECT_ATTEMPTS
+        ))
 
-        self.def_usn = config.getValue("user-gen", "username", "")
-        self.def_host = config.getValue("user-gen", "serverip", "")
-        self.def_port = config.getValue("user-gen", "serverport", "")
+        self.def_usn = config.get_value("user-gen", "username", "")
+        self.def_host = config.get_value("user-gen", "serverip", "")
+        self.def_port = config.get_value("user-gen", "serverport", "")
 
         if not len(self.def_host):
-            self.def_host = config.getValue("default", "serverip", "")
+            self.def_host = config.get_value("default", "serverip", "")
 
         if not len(self.def_port):
-            self.def_port = config.getValue("default", "serverport", "")
+            self.def_port = config.get_value("default", "serverport", "")
 
     def __enter__(self):
         return self
@@ -32,96 +76,450 @@ class ClsCliConnector:
         return f"{self.def_host}:{self.def_port}"
 
     def connect(self, host, port, usn):
-        self.cli_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.cli_sock.connect((host, int(port)))
-        self.cli_sock.setblocking(False)
-        self.logger.info("Established connection with server")
-        # stream = None
-        while True:
-            try:
-                stream = self.cli_sock.recv(1024)
-                if not len(stream):
-                    raise Exception(
-                        "Established connection but no response from server, "
-                        "the server might have crashed"
-                    )
-                break
-            except IOError as e:
-                if e.errno != errno.EAGAIN and e.errno != errno.EWOULDBLOCK:
-                    print('Reading error: {}'.format(str(e)))
-                continue
-
-            except Exception as e:
-                self.logger.exception(e)
-                break
-
-        _, msg, _ = CommPacket.from_stream(stream, self.codec)
+        self._closing.clear()
+        self.resumeState.clear()
+        self._outbox.clear()
+        stream = self._handshake(host, port, usn)
 
-        msg = msg.split("=")
-        if msg[0] == "HEADER_SIZE":
-            self.config.header_size = int(msg[1].strip())
+        self.host, self.port, self.usn = host, port, usn
+        self.isConnected = True
+        self._start_writer()
+        if self.clockThread is None or not self.clockThread.is_alive():
+            self.clockThread = Thread(target=self._clock_loop, daemon=True)
+            self.clockThread.start()
+        return stream
 
-        self.logger.info("Received session header from server")
-        self.cli_sock.send(
-            CommPacket.to_stream(self.config, self.codec, (usn, None, False))
+    def listen(self, on_packet, on_close=None, on_interrupt=None,
+               on_resume=None):
+        self.listenerThread = Thread(
+            target=self._listen_loop,
+            args=(on_packet, on_close, on_interrupt, on_resume),
+            daemon=True
         )
+        self.listenerThread.start()
 
-        while True:
-            try:
-                stream = self.receive()
+    def disconnect(self):
+        self.isConnected = False
+        self._closing.set()
+        self._wake()
+        self._stop_writer()
+        if (
+            self.listenerThread is not None and
+            self.listenerThread is not current_thread()
+        ):
+            self.listenerThread.join(self.RECEIVE_TIMEOUT)
+        self.listenerThread = None
+        self.resumeState.clear()
+        self._outbox.clear()
+        self._close()
+        self.logger.info("Socket closed upon connection termination")
 
-                if stream is True:
-                    continue
+    def receive(self, timeout=RECEIVE_TIMEOUT):
+        if not len(self._backlog):
+            burst = self.receive_burst(timeout)
+            if burst is True or burst is False:
+                return burst
 
-                if stream is False:
-                    raise Exception(
-                        "Connection unexpectedly broken, try again"
-                    )
+            if not len(burst):
+                return True
 
-                _, msg, _ = stream
-                if "Welcome to the server" not in msg:
-                    raise Exception(msg)
+            self._backlog.extend(burst)
 
-                self.usn = usn
-                self.isConnected = True
-                return stream
+        return self._backlog.popleft()
 
-            except Exception as e:
-                self.logger.exception(e)
-                raise e
+    def receive_burst(self, timeout=RECEIVE_TIMEOUT):
+        burst = list(self._backlog)
+        self._backlog.clear()
+        try:
+            # Packets left over from receive(), e.g. those that came with
+            # the welcome, go out without waiting for more data
+            ready = self._wait_readable(0 if len(burst) else timeout)
+            if ready is None:
+                self._backlog.extend(burst)
+                return False
 
-    def disconnect(self):
-        self.isConnected = False
-        self.cli_sock.close()
-        self.logger.info("Socket closed upon connection termination")
+            if not ready:
+                return burst if len(burst) else True
 
-    def receive(self):
-        try:
-            msg_len = self.cli_sock.recv(self.config.header_size)
-            if not len(msg_len):
+            if not self.frameReader.fill(self.cli_sock):
                 return False
-            stream = self.cli_sock.recv(int(msg_len.decode('utf-8').strip()))
-            return CommPacket.from_stream(stream, self.codec)
+            self._lastReceiveMs = self.clock.local_ms()
+
+            for frame in self.frameReader.frames():
+                burst.append(
+                    CommPacket.from_stream(frame, self.codec, self.config)
+                )
+
+            return burst
 
         except IOError as e:
             if e.errno != errno.EAGAIN and e.errno != errno.EWOULDBLOCK:
                 self.logger.error(f"Reading error: {str(e)}")
                 raise e
-            return True
+            return burst if len(burst) else True
 
-    def send(self, msg, for_vlc):
-        self.cli_sock.send(
-            CommPacket.to_stream(
-                self.config, self.codec, (self.usn, msg, for_vlc)
-            )
+    @property
+    def queue_depth(self):
+        return len(self._outbox)
+
+    def send(self, msg, for_vlc, resume=None):
+        pack = (self.usn, msg, for_vlc)
+        if resume is not None:
+            self.resumeState[resume] = pack
+        self._enqueue(pack)
+
+    def send_command(self, opcode, *args):
+        pack = (
+            self.usn, to_text(opcode, *args), is_for_vlc(opcode),
+            int(opcode), args, self.clock.now(), next(self._seq)
         )
+        if opcode in (Opcode.VOTE, Opcode.CURRTIME):
+            self.resumeState[opcode.name] = pack
+        elif opcode is Opcode.UNVOTE:
+            self.resumeState.pop(Opcode.VOTE.name, None)
+
+        self._enqueue(pack, opcode if opcode in self.COALESCED else None)
+
+    def _enqueue(self, pack, key=None):
+        # Packs are encoded by the writer, a reconnect may renegotiate the
+        # wire format while they wait
+        with self._outboxCond:
+            if key is not None:
+                for entry in self._outbox:
+                    if entry[0] == key:
+                        # Dropped rather than replaced in place, so the new
+                        # pack stays behind play state changes queued since
+                        self._outbox.remove(entry)
+                        break
+
+            if not self._outboxCond.wait_for(
+                lambda: len(self._outbox) < self.SEND_QUEUE_SIZE or
+                not self.isConnected,
+                self.SEND_TIMEOUT
+            ):
+                raise Exception(
+                    f"Send queue full ({self.queue_depth} packets pending)"
+                )
+
+            self._outbox.append([key, pack])
+            self._outboxCond.notify_all()
+
+    def _write_loop(self):
+        while True:
+            with self._outboxCond:
+                self._outboxCond.wait_for(
+                    lambda: len(self._outbox) or self._writerStop
+                )
+                if self._writerStop:
+                    break
+
+                packs = [pack for _, pack in self._outbox]
+                self._outbox.clear()
+                self._outboxCond.notify_all()
+
+            batch = [
+                CommPacket.to_stream(self.config, self.codec, pack)
+                for pack in packs
+            ]
+            if len(batch) > 1:
+                self.logger.debug("Flushing %d queued packets", len(batch))
+
+            try:
+                self._write_all(batch)
+
+            except OSError as e:
+                self.logger.error(f"Writing error: {str(e)}")
+                # The listener sees the dead socket and runs the reconnect,
+                # which starts a fresh writer
+                try:
+                    self.cli_sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                break
+
+    def _write_all(self, frames):
+        views = deque(memoryview(frame) for frame in frames)
+        while len(views):
+            if not len(self.writeSelector.select(self.SEND_TIMEOUT)):
+                raise TimeoutError("Timed out waiting for socket to drain")
+
+            try:
+                if hasattr(self.cli_sock, "sendmsg"):
+                    sent = self.cli_sock.sendmsg(views)
+                else:
+                    sent = self.cli_sock.send(b"".join(views))
+
+            except BlockingIOError:
+                continue
+
+            # Drop what went out and keep the tail of a short write
+            while sent:
+                if sent >= len(views[0]):
+                    sent -= len(views.popleft())
+                else:
+                    views[0] = views[0][sent:]
+                    sent = 0
+
+    def _start_writer(self):
+        self._writerStop = False
+        self.writerThread = Thread(target=self._write_loop, daemon=True)
+        self.writerThread.start()
+
+    def _stop_writer(self):
+        with self._outboxCond:
+            self._writerStop = True
+            self._outboxCond.notify_all()
+
+        if (
+            self.writerThread is not None and
+            self.writerThread is not current_thread()
+        ):
+            self.writerThread.join(self.SEND_TIMEOUT)
+        self.writerThread = None
 
     def setKey(self, key):
         self.codec = ClsEncryptTool(key)
         self.logger.debug(f"{self.codec.key=}")
 
+    def _parse_session_header(self, msg):
+        # "HEADER_SIZE=10" from older servers, newer ones append
+        # ";"-separated capabilities such as "WIRE=1"
+        capabilities = {}
+        for entry in msg.split(";"):
+            key, _, value = entry.partition("=")
+            capabilities[key.strip()] = value.strip()
+
+        return capabilities
+
+    def _negotiate_wire_version(self):
+        offered = self.capabilities.get("WIRE")
+        if not offered:
+            return None
+
+        common = set(WIRE_VERSIONS).intersection(
+            int(ver) for ver in offered.split(",")
+        )
+        return max(common) if len(common) else None
+
+    def _handshake(self, host, port, usn):
+        try:
+            self.cli_sock = socket.create_connection(
+                (host, int(port)), timeout=self.CONNECT_TIMEOUT
+            )
+            self.cli_sock.setblocking(False)
+            self._open_selector()
+            self.logger.info("Established connection with server")
+
+            if not self._wait_readable(self.HANDSHAKE_TIMEOUT):
+                raise Exception(
+                    "Established connection but no response from server, "
+                    "the server might be busy"
+                )
+
+            stream = self.cli_sock.recv(1024)
+            if not len(stream):
+                raise Exception(
+                    "Established connection but no response from server, "
+                    "the server might have crashed"
+                )
+
+            self.config.wire_version = None
+            header = CommPacket.from_stream(memoryview(stream), self.codec)
+
+            self.capabilities = self._parse_session_header(header.message)
+            if "HEADER_SIZE" in self.capabilities:
+                self.config.header_size = int(
+                    self.capabilities["HEADER_SIZE"]
+                )
+
+            wire_version = self._negotiate_wire_version()
+            self.logger.info("Received session header from server")
+            self.cli_sock.send(CommPacket.to_stream(
+                self.config, self.codec, (
+                    usn,
+                    f"WIRE={wire_version}"
+                    if wire_version is not None else None,
+                    False
+                )
+            ))
+
+            self.config.wire_version = wire_version
+            self.frameReader = ClsFrameReader(
+                self.config.header_size, binary=wire_version is not None
+            )
+            self._backlog.clear()
+
+            stream = self.receive(self.HANDSHAKE_TIMEOUT)
+
+            if stream is True:
+                raise Exception("Timed out waiting for the server to respond")
+
+            if stream is False:
+                raise Exception(
+                    "Connection unexpectedly broken, try again"
+                )
+
+            if "Welcome to the server" not in stream.message:
+                raise Exception(stream.message)
+
+            return stream
+
+        except Exception as e:
+            self.logger.exception(e)
+            self._close()
+            raise e
+
+    def _reconnect(self):
+        self.isReconnecting = True
+        self._stop_writer()
+        self._close()
+
+        delay = self.RECONNECT_BASE_DELAY
+        for attempt in range(1, self.reconnectAttempts + 1):
+            # Full jitter keeps a lobby of clients from retrying in lockstep
+            if self._closing.wait(random.uniform(0, delay)):
+                break
+
+            self.logger.info(f"Reconnect attempt {attempt}")
+            try:
+                stream = self._handshake(self.host, self.port, self.usn)
+
+            except Exception as e:
+                self.logger.warning(f"Reconnect attempt failed: {str(e)}")
+                delay = min(delay * 2, self.RECONNECT_MAX_DELAY)
+                continue
+
+            if self._closing.is_set():
+                # disconnect() ran during the handshake, do not linger on
+                # the server as a ghost lobby member
+                self._close()
+                break
+
+            self._resume_session()
+            self._start_writer()
+            self.isReconnecting = False
+            self.logger.info("Reconnected, session state replayed")
+            return stream
+
+        self.isReconnecting = False
+        return None
+
+    def _resume_session(self):
+        with self._outboxCond:
+            self._outbox.extendleft(reversed([
+                [None, pack] for pack in self.resumeState.values()
+            ]))
+
+    def _clock_loop(self):
+        probes = 0
+        while not self._closing.wait(
+            self.CLOCK_PROBE_SPACING if probes < self.CLOCK_PROBE_BURST
+            else self.CLOCK_SYNC_INTERVAL
+        ):
+            if (
+                not self.isConnected or self.isReconnecting or
+                "CLOCK" not in self.capabilities
+            ):
+                continue
+
+            try:
+                self.send_command(Opcode.PING, self.clock.local_ms())
+                probes += 1
+
+            except Exception as e:
+                self.logger.warning(f"Clock probe failed: {str(e)}")
+
+    def _listen_loop(self, on_packet, on_close, on_interrupt, on_resume):
+        while self.isConnected:
+            try:
+                burst = self.receive_burst(None)
+
+            except Exception as e:
+                self.logger.exception(e)
+                burst = False
+
+            if burst is True:
+                continue
+
+            if burst is False:
+                if not self.isConnected:
+                    break
+
+                self.logger.warning("Connection lost, reconnecting")
+                if on_interrupt is not None:
+                    on_interrupt()
+
+                stream = self._reconnect()
+                if stream is None:
+                    break
+
+                if on_resume is not None:
+                    on_resume(stream)
+                continue
+
+            for packet in burst:
+                if packet.opcode == Opcode.PONG:
+                    offset, delay = self.clock.add_sample(
+                        *packet.args, self._lastReceiveMs
+                    )
+                    self.logger.debug(
+                        "Clock sample offset=%sms delay=%sms", offset, delay
+                    )
+                    continue
+
+                on_packet(packet)
+
+        if self.isConnected:
+            self.isConnected = False
+            self._close()
+            if on_close is not None:
+                on_close()
+
+    def _open_selector(self):
+        self.selector = selectors.DefaultSelector()
+        self._waker, self._wake_sock = socket.socketpair()
+        self._waker.setblocking(False)
+        self._wake_sock.setblocking(False)
+        self.selector.register(self.cli_sock, selectors.EVENT_READ)
+        self.selector.register(self._waker, selectors.EVENT_READ)
+        self.writeSelector = selectors.DefaultSelector()
+        self.writeSelector.register(self.cli_sock, selectors.EVENT_WRITE)
+
+    def _wait_readable(self, timeout):
+        # None signals a wake-up from disconnect() rather than readable data
+        if self.selector is None:
+            return None
+
+        ready = False
+        for key, _ in self.selector.select(timeout):
+            if key.fileobj is self._waker:
+                return None
+            ready = True
+
+        return ready
+
+    def _wake(self):
+        try:
+            self._wake_sock.send(b"\0")
+        except (AttributeError, OSError):
+            pass
+
+    def _close(self):
+        if self.selector is not None:
+            self.selector.close()
+            self.writeSelector.close()
+            self.selector = None
+            self._waker.close()
+            self._wake_sock.close()
+
+        if hasattr(self, "cli_sock"):
+            self.cli_sock.close()
+
     def __exit__(self, exc_type, exc_value, exc_traceback):
         if hasattr(self, "cli_sock"):
             self.isConnected = False
-            self.cli_sock.close()
+            self._closing.set()
+            self._wake()
+            self._stop_writer()
+            self._close()
             self.logger.info("Socket closed upon exit")
@@ -0,0 +1,35 @@
+from time import time_ns
+from collections import deque
+
+
+class ClsClockSync:
+    SAMPLES = 8
+
+    def __init__(self):
+        self.samples = deque(maxlen=self.SAMPLES)
+        # Until the server answers a probe, assume NTP synced wall clocks
+        self.offset = 0
+        self.delay = None
+
+    @staticmethod
+    def local_ms():
+        return time_ns() // 10**6
+
+    def now(self):
+        return self.local_ms() + self.offset
+
+    def add_sample(self, t0, t1, t2, t3):
+        # t0/t3 are local send/receive times, t1/t2 the server's
+        offset = ((t1 - t0) + (t2 - t3)) // 2
+        delay = (t3 - t0) - (t2 - t1)
+        self.samples.append((delay, offset))
+
+        # The sample with the shortest round trip suffered the least
+        # queuing, so its offset is the most trustworthy
+        self.delay, self.offset = min(self.samples)
+        return offset, delay
+
+    def one_way_delay(self, sent_at):
+        if sent_at is None:
+            return 0
+        return max(0, self.now() - sent_at)
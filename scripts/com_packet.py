@@ -1,41 +1,174 @@
 import pickle
+import struct
 from dataclasses import dataclass
 
+WIRE_MAGIC = 0xC5
+WIRE_VERSIONS = (1,)
+
+# magic, version, flags, field count
+WIRE_HEADER = struct.Struct("!BBBB")
+# field tag, field length
+WIRE_FIELD = struct.Struct("!BI")
+# binary frame length prefix, replaces the padded ASCII header once negotiated
+WIRE_LENGTH = struct.Struct("!I")
+
+# opcode followed by its signed 64 bit arguments
+WIRE_COMMAND = struct.Struct("!B")
+WIRE_ARG = struct.Struct("!q")
+
+FLAG_FOR_VLC = 0x01
+TAG_USERNAME = 1
+TAG_MESSAGE = 2
+TAG_COMMAND = 3
+TAG_SENT_AT = 4
+TAG_SEQ = 5
+
 
 @dataclass
 class CommPacket:
     username: str
     message: str
     forVLC: bool
+    opcode: int = None
+    args: tuple = ()
+    # Sender's estimate of the server clock in ms, for delay compensation
+    sent_at: int = None
+    # Per sender command counter, identifies where a state change came from
+    seq: int = None
 
     @staticmethod
-    def create_packet(usn, message, forVLC):
-        return CommPacket(usn, message, forVLC)
+    def create_packet(usn, message, forVLC, opcode=None, args=(),
+                      sent_at=None, seq=None):
+        return CommPacket(
+            usn, message, forVLC, opcode, tuple(args), sent_at, seq
+        )
+
+    @staticmethod
+    def origin(pack):
+        return f"{pack.username}#{pack.seq}"
 
     @staticmethod
     def unravel_packet(pack):
         return pack.username, pack.message, pack.forVLC
 
     @staticmethod
-    def to_stream(config, codec, pack, init=False):
-        nonce, cipher_text, tag = codec.encrypt(
-            pickle.dumps(CommPacket.create_packet(*pack))
+    def encode(pack):
+        pack = CommPacket.create_packet(*pack)
+        fields = []
+        for tag, value in (
+            (TAG_USERNAME, pack.username),
+            (TAG_MESSAGE, pack.message),
+            (TAG_COMMAND, CommPacket._encode_command(pack)),
+            (
+                TAG_SENT_AT,
+                WIRE_ARG.pack(pack.sent_at)
+                if pack.sent_at is not None else None
+            ),
+            (
+                TAG_SEQ,
+                WIRE_ARG.pack(pack.seq) if pack.seq is not None else None
+            )
+        ):
+            if value is None:
+                continue
+            if isinstance(value, str):
+                value = value.encode('utf-8')
+            fields.append(WIRE_FIELD.pack(tag, len(value)))
+            fields.append(value)
+
+        return WIRE_HEADER.pack(
+            WIRE_MAGIC, WIRE_VERSIONS[-1],
+            FLAG_FOR_VLC if pack.forVLC else 0, len(fields) // 2
+        ) + b"".join(fields)
+
+    @staticmethod
+    def decode(stream):
+        magic, version, flags, count = WIRE_HEADER.unpack_from(stream)
+        if magic != WIRE_MAGIC or version not in WIRE_VERSIONS:
+            raise Exception(f"Unsupported wire format {magic=} {version=}")
+
+        pack = CommPacket(None, None, bool(flags & FLAG_FOR_VLC))
+        offset = WIRE_HEADER.size
+        for _ in range(count):
+            tag, length = WIRE_FIELD.unpack_from(stream, offset)
+            offset += WIRE_FIELD.size
+            if tag == TAG_USERNAME:
+                pack.username = str(stream[offset:offset+length], 'utf-8')
+            elif tag == TAG_MESSAGE:
+                pack.message = str(stream[offset:offset+length], 'utf-8')
+            elif tag == TAG_COMMAND:
+                CommPacket._decode_command(pack, stream, offset, length)
+            elif tag == TAG_SENT_AT:
+                pack.sent_at, = WIRE_ARG.unpack_from(stream, offset)
+            elif tag == TAG_SEQ:
+                pack.seq, = WIRE_ARG.unpack_from(stream, offset)
+            offset += length
+
+        return pack
+
+    @staticmethod
+    def _encode_command(pack):
+        if pack.opcode is None:
+            return None
+
+        return WIRE_COMMAND.pack(pack.opcode) + b"".join(
+            WIRE_ARG.pack(arg) for arg in pack.args
         )
-        enc_stream = nonce+tag+cipher_text
-        if not init:
-            return (
-                f"{len(enc_stream):<{config.header_size}}".encode('utf-8') +
-                enc_stream
+
+    @staticmethod
+    def _decode_command(pack, stream, offset, length):
+        pack.opcode, = WIRE_COMMAND.unpack_from(stream, offset)
+        pack.args = tuple(
+            WIRE_ARG.unpack_from(stream, arg_offset)[0]
+            for arg_offset in range(
+                offset + WIRE_COMMAND.size, offset + length, WIRE_ARG.size
             )
-        return enc_stream
+        )
 
     @staticmethod
-    def from_stream(enc_stream, codec):
+    def is_binary(config):
+        return getattr(config, "wire_version", None) is not None
+
+    @staticmethod
+    def to_stream(config, codec, pack, init=False):
+        if CommPacket.is_binary(config):
+            payload = CommPacket.encode(pack)
+        else:
+            payload = pickle.dumps(CommPacket.create_packet(*pack))
+
+        nonce, cipher_text, tag = codec.encrypt(payload)
+        enc_stream = nonce+tag+cipher_text
+        if init:
+            return enc_stream
+
+        if CommPacket.is_binary(config):
+            return WIRE_LENGTH.pack(len(enc_stream)) + enc_stream
+
+        return (
+            f"{len(enc_stream):<{config.header_size}}".encode('utf-8') +
+            enc_stream
+        )
+
+    @staticmethod
+    def from_stream(enc_stream, codec, config=None):
+        # enc_stream may be a memoryview over the receive buffer, slicing it
+        # hands views rather than copies to the cipher
         nonce = enc_stream[:16]
         tag = enc_stream[16:32]
         cipher_text = enc_stream[32:]
         dec_stream = codec.decrypt(nonce, cipher_text, tag)
-        if dec_stream:
-            return CommPacket.unravel_packet(pickle.loads(dec_stream))
+        if not dec_stream:
+            raise Exception("Failed to decrypt")
+
+        if dec_stream[0] == WIRE_MAGIC:
+            return CommPacket.decode(dec_stream)
 
-        raise Exception("Failed to decrypt")
+        if CommPacket.is_binary(config):
+            raise Exception("Refusing legacy packet on a binary session")
+
+        pack = pickle.loads(dec_stream)
+        return CommPacket.create_packet(
+            *CommPacket.unravel_packet(pack),
+            getattr(pack, "opcode", None), getattr(pack, "args", ()),
+            getattr(pack, "sent_at", None), getattr(pack, "seq", None)
+        )
@@ -61,6 +61,11 @@ class ClsConfigParser:
             "user-gen": {
                 "username": "new_user",
                 "serverip": "127.0.0.1"
+            },
+            "logging": {
+                "level": "INFO",
+                "maxbytes": 5 * 2**20,
+                "backupcount": 3
             }
         })
         self.save_config()
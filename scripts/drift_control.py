@@ -0,0 +1,31 @@
+class ClsDriftController:
+    # Rate change per second of drift, and the most it may deviate from 1x
+    GAIN = 0.1
+    MAX_NUDGE = 0.03
+    # Drift (seconds) considered converged, and beyond which to seek
+    DEADBAND = 0.05
+    SEEK_THRESHOLD = 1.5
+
+    def __init__(self, seek_threshold=SEEK_THRESHOLD):
+        self.seek_threshold = seek_threshold
+        self.rate = 1.0
+
+    def reset(self):
+        self.rate = 1.0
+
+    def update(self, drift):
+        # drift is our position minus the reference, positive when ahead.
+        # Returns the playback rate to apply, or None when we have fallen
+        # too far behind and must seek. Peers that are too far ahead hold
+        # at 1x and wait for the others to jump forward to them
+        if abs(drift) > self.seek_threshold:
+            self.rate = 1.0
+            return None if drift < 0 else self.rate
+
+        if abs(drift) <= self.DEADBAND:
+            self.rate = 1.0
+            return self.rate
+
+        nudge = max(-self.MAX_NUDGE, min(self.MAX_NUDGE, -self.GAIN * drift))
+        self.rate = round(1.0 + nudge, 3)
+        return self.rate
@@ -0,0 +1,41 @@
+from time import monotonic
+
+
+class ClsEchoGuard:
+    # How long an applied remote command may take to show up in VLC
+    WINDOW = 2
+    SEEK_TOLERANCE = 1
+
+    def __init__(self, clock=monotonic):
+        self.clock = clock
+        self.pending = {}
+
+    def expect(self, kind, value, origin):
+        self.pending[kind] = (value, origin, self.clock())
+
+    def clear(self):
+        self.pending.clear()
+
+    def filter(self, kind, observed):
+        # Returns the origin of the remote command when the observation has
+        # to be swallowed, either because it is that command taking effect
+        # or because VLC has not caught up with it yet. None otherwise
+        entry = self.pending.get(kind)
+        if entry is None:
+            return None
+
+        value, origin, since = entry
+        elapsed = self.clock() - since
+        if elapsed > self.WINDOW:
+            del self.pending[kind]
+            return None
+
+        if kind == "seek":
+            matched = abs(observed - value) <= self.SEEK_TOLERANCE + elapsed
+        else:
+            matched = observed == value
+
+        if matched:
+            del self.pending[kind]
+
+        return origin
@@ -0,0 +1,240 @@
+import sys
+import errno
+import socket
+import selectors
+
+from scripts.com_packet import CommPacket, WIRE_VERSIONS
+from scripts.frame_reader import ClsFrameReader
+from scripts.protocol import Opcode, parse_text
+from scripts.clock_sync import ClsClockSync
+from scripts.encryption import ClsEncryptTool
+from scripts.logger import VLCync_Logger
+
+
+class _Peer:
+    def __init__(self, sock, header_size):
+        self.sock = sock
+        self.header_size = header_size
+        self.wire_version = None
+        self.reader = ClsFrameReader(header_size)
+        self.username = None
+        self.hash = None
+        self.voted = False
+        self.outbuf = bytearray()
+
+
+class ClsFakeServer:
+    # Loopback stand-in for the VLCync server: session header, welcome,
+    # hash matching, votes, PING/PONG and relaying of sync commands and chat
+    NAME = "SERVER"
+    HASH_PREFIX = "SELECTED FILE HASH="
+
+    def __init__(
+        self, key, host="127.0.0.1", port=0, header_size=10,
+        capabilities=(
+            f"WIRE={','.join(map(str, WIRE_VERSIONS))};"
+            "CLOCK;BEACON;VERIFY;RANK"
+        )
+    ):
+        self.logger = VLCync_Logger.get_logger('Server')
+        self.codec = ClsEncryptTool(key)
+        self.header_size = header_size
+        self.session_header = f"HEADER_SIZE={header_size};{capabilities}"
+        self.selector = selectors.DefaultSelector()
+        self.listener = socket.create_server((host, port))
+        self.listener.setblocking(False)
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self.peers = {}
+        self.relayed = 0
+
+    @property
+    def address(self):
+        return self.listener.getsockname()[:2]
+
+    def serve_forever(self):
+        while True:
+            for key, events in self.selector.select():
+                if key.fileobj is self.listener:
+                    self._accept()
+                    continue
+
+                peer = self.peers.get(key.fileobj)
+                if peer is None:
+                    continue
+
+                try:
+                    if events & selectors.EVENT_WRITE:
+                        self._flush(peer)
+                    if (
+                        events & selectors.EVENT_READ and
+                        peer.sock in self.peers
+                    ):
+                        self._read(peer)
+
+                except OSError as e:
+                    self.logger.warning(f"Dropping {peer.username}: {e}")
+                    self._drop(peer)
+
+    def _accept(self):
+        sock, _ = self.listener.accept()
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        peer = _Peer(sock, self.header_size)
+        self.peers[sock] = peer
+        self.selector.register(sock, selectors.EVENT_READ)
+        self._send(peer, (self.NAME, self.session_header, False), init=True)
+
+    def _drop(self, peer):
+        if peer.sock not in self.peers:
+            return
+
+        self.selector.unregister(peer.sock)
+        del self.peers[peer.sock]
+        peer.sock.close()
+        self._check_votes()
+
+    def _read(self, peer):
+        try:
+            if not peer.reader.fill(peer.sock):
+                self._drop(peer)
+                return
+
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+
+        for frame in peer.reader.frames():
+            packet = CommPacket.from_stream(frame, self.codec, peer)
+            if peer.username is None:
+                self._welcome(peer, packet)
+                # The client waits for the welcome before sending anything
+                # else, so nothing is left in the old reader
+                break
+
+            self._handle(peer, packet)
+            if peer.sock not in self.peers:
+                break
+
+    def _welcome(self, peer, packet):
+        peer.username = packet.username
+        offered = (packet.message or "").partition("WIRE=")[2]
+        if offered.isdigit() and int(offered) in WIRE_VERSIONS:
+            peer.wire_version = int(offered)
+            peer.reader = ClsFrameReader(peer.header_size, binary=True)
+
+        self._send(peer, (self.NAME, "Welcome to the server", False))
+
+    def _handle(self, peer, packet):
+        opcode, args = packet.opcode, packet.args
+        if opcode is None:
+            opcode, args = parse_text(packet.message, packet.forVLC)
+            if packet.message in ("VOTE", "UNVOTE"):
+                opcode = Opcode[packet.message]
+
+        if opcode == Opcode.PING:
+            received = ClsClockSync.local_ms()
+            self._send(peer, (
+                self.NAME, "PONG", False, int(Opcode.PONG),
+                (*args, received, ClsClockSync.local_ms())
+            ))
+
+        elif opcode in (Opcode.VOTE, Opcode.UNVOTE):
+            peer.voted = opcode == Opcode.VOTE
+            self._check_votes()
+
+        elif opcode == Opcode.CURRTIME:
+            pass
+
+        elif (packet.message or "").startswith(self.HASH_PREFIX):
+            peer.hash = packet.message[len(self.HASH_PREFIX):]
+            self._check_hashes()
+
+        else:
+            self._relay(peer, packet)
+
+    def _check_hashes(self):
+        hashes = {peer.hash for peer in self.peers.values()}
+        if None in hashes:
+            return
+
+        self._broadcast((
+            self.NAME,
+            "HASHES MATCH" if len(hashes) == 1 else "HASHES DO NOT MATCH",
+            False
+        ))
+
+    def _check_votes(self):
+        if len(self.peers) and all(
+            peer.voted for peer in self.peers.values()
+        ):
+            for peer in self.peers.values():
+                peer.voted = False
+            self._broadcast((self.NAME, "EVERYONE HAS VOTED", False))
+
+    def _relay(self, sender, packet):
+        self.relayed += 1
+        self._broadcast((
+            packet.username, packet.message, packet.forVLC, packet.opcode,
+            packet.args, packet.sent_at, packet.seq
+        ), exclude=sender)
+
+    def _broadcast(self, pack, exclude=None):
+        # Encrypt once per wire format rather than once per recipient
+        frames = {}
+        for peer in list(self.peers.values()):
+            if peer is exclude or peer.username is None:
+                continue
+
+            if peer.wire_version not in frames:
+                frames[peer.wire_version] = CommPacket.to_stream(
+                    peer, self.codec, pack
+                )
+            self._write(peer, frames[peer.wire_version])
+
+    def _send(self, peer, pack, init=False):
+        self._write(peer, CommPacket.to_stream(peer, self.codec, pack, init))
+
+    def _write(self, peer, frame):
+        pending = len(peer.outbuf)
+        peer.outbuf += frame
+        if not pending:
+            try:
+                self._flush(peer)
+            except OSError as e:
+                self.logger.warning(f"Dropping {peer.username}: {e}")
+                self._drop(peer)
+
+    def _flush(self, peer):
+        if len(peer.outbuf):
+            try:
+                sent = peer.sock.send(peer.outbuf)
+                del peer.outbuf[:sent]
+            except BlockingIOError:
+                pass
+
+        self.selector.modify(
+            peer.sock,
+            selectors.EVENT_READ | selectors.EVENT_WRITE
+            if len(peer.outbuf) else selectors.EVENT_READ
+        )
+
+
+def main(argv):
+    if not len(argv):
+        print("Usage: python -m scripts.fake_server <key> [port]")
+        return 1
+
+    server = ClsFakeServer(argv[0], port=int(argv[1]) if len(argv) > 1 else 0)
+    host, port = server.address
+    print(f"Fake server listening on {host}:{port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,186 @@
+import sys
+import random
+from time import sleep, monotonic
+from threading import Thread, Lock
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class ClsMediaClock:
+    def __init__(self, length, clock=monotonic):
+        self.clock = clock
+        self.length = length
+        self.state = "stopped"
+        self.rate = 1.0
+        self.anchor_time = 0.0
+        self.anchor_seen = clock()
+
+    def time(self):
+        if self.state != "playing":
+            return self.anchor_time
+
+        elapsed = (self.clock() - self.anchor_seen) * self.rate
+        return min(self.length, self.anchor_time + elapsed)
+
+    def _reanchor(self, time=None):
+        self.anchor_time = self.time() if time is None else time
+        self.anchor_seen = self.clock()
+
+    def play(self, time=None):
+        self._reanchor(time)
+        self.state = "playing"
+
+    def toggle(self):
+        self._reanchor()
+        self.state = "paused" if self.state == "playing" else "playing"
+
+    def seek(self, val):
+        # Same forms VLC accepts: seconds, percent of length, relative
+        current = self.time()
+        if val.endswith("%"):
+            target = float(val[:-1]) * self.length / 100
+        elif val[0] in "+-":
+            target = current + float(val)
+        else:
+            target = float(val)
+        self._reanchor(max(0.0, min(self.length, target)))
+
+    def set_rate(self, val):
+        self._reanchor()
+        self.rate = float(val)
+
+
+class _FakeVLCHandler(BaseHTTPRequestHandler):
+    # Keep-alive, like VLC's own interface. Headers and body go out in
+    # separate writes, which Nagle would hold back for a delayed ACK
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server.owner
+        url = urlsplit(self.path)
+        if url.path != "/requests/status.xml":
+            self.send_error(404)
+            return
+
+        server.delay()
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        body = server.apply(query.get("command"), query)
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml; charset=UTF-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ClsFakeVLC:
+    # Serves /requests/status.xml the way VLC's HTTP interface does, over a
+    # simulated media clock, so the player modules can be exercised without
+    # a real VLC
+    def __init__(
+        self, host="127.0.0.1", port=0, latency=0.0, jitter=0.0,
+        length=7260, start_paused=True
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.media = ClsMediaClock(length)
+        # VLC launched with --start-paused loads media without playing it
+        self.start_paused = start_paused
+        self.lock = Lock()
+        self.commands = 0
+        self.polls = 0
+        self.httpd = ThreadingHTTPServer((host, port), _FakeVLCHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.owner = self
+        self.serverThread = None
+
+    @property
+    def address(self):
+        return self.httpd.server_address[:2]
+
+    def start(self):
+        self.serverThread = Thread(
+            target=self.httpd.serve_forever, daemon=True
+        )
+        self.serverThread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def delay(self):
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            sleep(delay)
+
+    def apply(self, command, query):
+        with self.lock:
+            if command is None:
+                self.polls += 1
+            else:
+                self.commands += 1
+
+            if command == "in_play":
+                self.media.play(0.0)
+                if self.start_paused:
+                    self.media.toggle()
+            elif command == "pl_pause":
+                self.media.toggle()
+            elif command in ("pl_play", "pl_forceresume"):
+                self.media.play()
+            elif command == "pl_forcepause" and self.media.state == "playing":
+                self.media.toggle()
+            elif command == "seek" and query.get("val"):
+                self.media.seek(query["val"])
+            elif command == "rate" and query.get("val"):
+                self.media.set_rate(query["val"])
+
+            return self.status_xml()
+
+    def status_xml(self):
+        media = self.media
+        time = media.time()
+        position = time / media.length if media.length else 0
+        return (
+            "<?xml version=\"1.0\" encoding=\"utf-8\" standalone=\"yes\" ?>"
+            "<root><fullscreen>false</fullscreen><apiversion>3</apiversion>"
+            f"<currentplid>4</currentplid><time>{int(time)}</time>"
+            f"<volume>256</volume><length>{media.length}</length>"
+            f"<rate>{media.rate}</rate><state>{media.state}</state>"
+            "<version>3.0.18 Vetinari</version>"
+            f"<position>{position}</position><information><category "
+            "name='meta'><info name='filename'>sample.mkv</info></category>"
+            "</information><stats><inputbitrate>0</inputbitrate></stats>"
+            "</root>"
+        ).encode('utf-8')
+
+
+def main(argv):
+    defaults = ["44500", "0", "0"]
+    port, latency, jitter = [*argv, *defaults[len(argv):]][:3]
+    with ClsFakeVLC(
+        port=int(port), latency=float(latency), jitter=float(jitter)
+    ) as fake:
+        print(f"Fake VLC listening on {fake.address[0]}:{fake.address[1]}")
+        try:
+            while True:
+                sleep(1)
+        except KeyboardInterrupt:
+            pass
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,60 @@
+from scripts.com_packet import WIRE_LENGTH
+
+
+class ClsFrameReader:
+    INITIAL_CAPACITY = 2**16
+
+    def __init__(self, header_size, binary=False):
+        self.binary = binary
+        self.header_size = WIRE_LENGTH.size if binary else header_size
+        self._buf = bytearray(self.INITIAL_CAPACITY)
+        self._start = 0
+        self._end = 0
+
+    def fill(self, sock):
+        # Frames handed out by frames() point into the buffer, they must be
+        # consumed before the next fill() since compaction overwrites them
+        if self._end == len(self._buf):
+            self._compact()
+
+        received = sock.recv_into(memoryview(self._buf)[self._end:])
+        self._end += received
+        return received
+
+    def frames(self):
+        view = memoryview(self._buf)
+        while True:
+            available = self._end - self._start
+            if available < self.header_size:
+                break
+
+            body_start = self._start + self.header_size
+            if self.binary:
+                length, = WIRE_LENGTH.unpack_from(self._buf, self._start)
+            else:
+                length = int(bytes(view[self._start:body_start]))
+            if available < self.header_size + length:
+                if self.header_size + length > len(self._buf) - self._start:
+                    self._grow(self.header_size + length)
+                break
+
+            self._start = body_start + length
+            yield view[body_start:self._start]
+
+        if self._start == self._end:
+            self._start = self._end = 0
+
+    def pending(self):
+        return self._end - self._start
+
+    def _compact(self):
+        pending = self.pending()
+        self._buf[:pending] = self._buf[self._start:self._end]
+        self._start, self._end = 0, pending
+
+    def _grow(self, size):
+        pending = self.pending()
+        buf = bytearray(max(size, 2 * len(self._buf)))
+        buf[:pending] = self._buf[self._start:self._end]
+        self._buf = buf
+        self._start, self._end = 0, pending
@@ -1,55 +1,246 @@
+import os
 import hashlib
 import zlib
+from functools import lru_cache
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
 
 #Bytes
-LIMIT = 2**31
-BLOCKSIZE = 2**18
-
-def getHash(file, algo="crc32"):
-    return {
-        "crc32": _crc32,
-        "md5": _md5,
-        "sha1": _sha1,
-        "sha256": _sha256
-    }.get(algo, _crc32)(file)
-
-def _crc32(fileName):
-    with open(fileName, 'rb') as fh:
-        hash = 0
-        count = 0
-        while True:
-            count += BLOCKSIZE
-            s = fh.read(BLOCKSIZE)
-            if not s:
-                break
-            hash = zlib.crc32(s, hash)
-            if not (count % LIMIT):
-                break
-
-        return "%08X" % (hash & 0xFFFFFFFF)
-
-def _md5(fileName):
-    hasher = hashlib.md5()
-    return _hashlib_reader(fileName, hasher)
-
-def _sha1(fileName):
-    hasher = hashlib.sha1()
-    return _hashlib_reader(fileName, hasher)
-
-def _sha256(fileName):
-    hasher = hashlib.sha256()
-    return _hashlib_reader(fileName, hasher)
-
-def _hashlib_reader(file, hasher):
-    with open(file, 'rb') as afile:
-        count = 0
-        buf = afile.read(BLOCKSIZE)
-        while len(buf) > 0:
-            count += BLOCKSIZE
-            # print(f"{len(buf) = }", end="\r")
-            hasher.update(buf)
-            buf = afile.read(BLOCKSIZE)
-            if not count % LIMIT:
-                break
+BLOCKSIZE = 2**20
+# Span hashed by each worker in the "<algo>-tree" modes
+CHUNKSIZE = 2**26
+WORKERS = min(8, os.cpu_count() or 1)
+TREE_SUFFIX = "-tree"
+# The "sample" fingerprint reads this many evenly spaced blocks, head and
+# tail included, so its cost does not grow with the file
+SAMPLE_COUNT = 16
+SAMPLE_SIZE = 2**16
+# In-memory data each algorithm is timed on when ranking them for "auto"
+RANK_SIZE = 2**24
+
+
+class HashCancelled(Exception):
+    pass
+
+
+class _Crc32:
+    # hashlib-like wrapper so every algorithm goes through one reader
+    CHECKSUM = staticmethod(zlib.crc32)
+    INITIAL = 0
+
+    def __init__(self):
+        self.value = self.INITIAL
+
+    def update(self, data):
+        self.value = self.CHECKSUM(data, self.value)
+
+    def digest(self):
+        return (self.value & 0xFFFFFFFF).to_bytes(4, "big")
+
+    def hexdigest(self):
+        return "%08X" % (self.value & 0xFFFFFFFF)
+
+
+class _Adler32(_Crc32):
+    CHECKSUM = staticmethod(zlib.adler32)
+    INITIAL = 1
+
+
+class _Tee:
+    def __init__(self, *hashers):
+        self.hashers = hashers
+
+    def update(self, data):
+        for hasher in self.hashers:
+            hasher.update(data)
+
+
+# Order is part of the protocol, rankings announce algorithms by index, so
+# new algorithms go at the end
+ALGORITHMS = {
+    "crc32": _Crc32,
+    "md5": hashlib.md5,
+    "sha1": hashlib.sha1,
+    "sha256": hashlib.sha256,
+    "adler32": _Adler32,
+    "blake2b": hashlib.blake2b,
+    "blake2s": hashlib.blake2s,
+    "sha224": hashlib.sha224,
+    "sha384": hashlib.sha384,
+    "sha512": hashlib.sha512,
+    "sha3_256": hashlib.sha3_256
+}
+ALGORITHM_IDS = tuple(ALGORITHMS)
+# Announced as bare digests, like older clients do
+LEGACY_ALGORITHMS = ("crc32", "md5", "sha1", "sha256")
+
+
+def getHash(
+    file, algo="crc32", block_size=BLOCKSIZE, workers=WORKERS,
+    progress=None, cancel=None, on_chunk=None
+):
+    # progress(n) is called with the byte count of every block read, from
+    # the worker threads in tree mode. Setting the cancel event aborts the
+    # hash with HashCancelled. on_chunk(index, digest) gets the digest of
+    # each CHUNKSIZE span in file order as soon as it is known, the same
+    # ones whether or not the tree variant is used.
+    #
+    # The algorithms older peers know keep their bare digest. Every other
+    # digest is prefixed with its algorithm so two different algorithms
+    # can never produce a match
+    watch = (progress, cancel)
+    if algo == "sample":
+        return f"sample:{_sample_hash(file, watch)}"
+
+    if algo.endswith(TREE_SUFFIX):
+        base = algo[:-len(TREE_SUFFIX)]
+        if base in ALGORITHMS:
+            digest = _tree_hash(
+                file, base, block_size, workers, watch, on_chunk
+            )
+            return f"{algo}:{digest}"
+
+    if algo not in ALGORITHMS:
+        algo = "crc32"
+    hasher = ALGORITHMS[algo]()
+    with open(file, 'rb') as fh:
+        _advise_sequential(fh)
+        if on_chunk is None:
+            _hash_range(fh, hasher, bytearray(block_size), 0, None, watch)
+        else:
+            _hash_chunked(
+                fh, hasher, algo, bytearray(block_size), watch, on_chunk
+            )
+
+    if algo in LEGACY_ALGORITHMS:
+        return hasher.hexdigest()
+    return f"{algo}:{hasher.hexdigest()}"
+
+
+@lru_cache(maxsize=1)
+def rank_algorithms(size=RANK_SIZE, block_size=BLOCKSIZE):
+    # Fastest first on this machine, timed on data already in memory so
+    # the disk does not flatten the differences
+    data = memoryview(os.urandom(block_size))
+    speeds = {}
+    for algo, factory in ALGORITHMS.items():
+        hasher = factory()
+        start = perf_counter()
+        for _ in range(size // block_size):
+            hasher.update(data)
+        speeds[algo] = size / (perf_counter() - start)
+
+    return sorted(ALGORITHMS, key=speeds.get, reverse=True)
+
+
+def pick_algorithm(rankings):
+    # rankings holds one fastest-first list per peer, ours included. Picks
+    # the algorithm everyone supports with the best total position, ties
+    # going to registry order so every peer reaches the same answer
+    common = [
+        algo for algo in ALGORITHM_IDS
+        if all(algo in ranking for ranking in rankings)
+    ]
+    if not len(common):
+        return "crc32"
+
+    return min(common, key=lambda algo: (
+        sum(ranking.index(algo) for ranking in rankings),
+        ALGORITHM_IDS.index(algo)
+    ))
+
+
+def _advise_sequential(fh, offset=0, length=0):
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(
+            fh.fileno(), offset, length, os.POSIX_FADV_SEQUENTIAL
+        )
+
+
+def _sample_hash(file, watch):
+    # Same size and same bytes at the same spots is taken as the same
+    # file. A re-encode or a different cut changes the size or the
+    # samples, which is what verification is for
+    size = os.path.getsize(file)
+    hasher = hashlib.sha256(size.to_bytes(8, "big"))
+    with open(file, 'rb') as fh:
+        if size <= SAMPLE_COUNT * SAMPLE_SIZE:
+            _hash_range(fh, hasher, bytearray(SAMPLE_SIZE), 0, None, watch)
+            return hasher.hexdigest()
+
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fh.fileno(), 0, 0, os.POSIX_FADV_RANDOM)
+
+        buf = bytearray(SAMPLE_SIZE)
+        for index in range(SAMPLE_COUNT):
+            offset = index * (size - SAMPLE_SIZE) // (SAMPLE_COUNT - 1)
+            _hash_range(fh, hasher, buf, offset, SAMPLE_SIZE, watch)
 
     return hasher.hexdigest()
+
+
+def _hash_range(fh, hasher, buf, offset, length, watch=(None, None)):
+    # Reads into the same buffer every time instead of allocating a new
+    # bytes object per block. length=None reads to the end of the file
+    progress, cancel = watch
+    view = memoryview(buf)
+    fh.seek(offset)
+    remaining = length
+    while remaining is None or remaining > 0:
+        if cancel is not None and cancel.is_set():
+            raise HashCancelled()
+
+        size = len(buf) if remaining is None else min(len(buf), remaining)
+        read = fh.readinto(view[:size])
+        if not read:
+            break
+
+        hasher.update(view[:read])
+        if progress is not None:
+            progress(read)
+        if remaining is not None:
+            remaining -= read
+
+
+def _hash_chunked(fh, hasher, algo, buf, watch, on_chunk):
+    # A single sequential pass that also yields the chunk digests
+    # _tree_hash would compute
+    size = os.fstat(fh.fileno()).st_size
+    for index, offset in enumerate(range(0, max(size, 1), CHUNKSIZE)):
+        chunk = ALGORITHMS[algo]()
+        _hash_range(fh, _Tee(hasher, chunk), buf, offset, CHUNKSIZE, watch)
+        on_chunk(index, chunk.digest())
+
+
+def _hash_chunk(file, algo, offset, block_size, watch):
+    hasher = ALGORITHMS[algo]()
+    with open(file, 'rb') as fh:
+        _advise_sequential(fh, offset, CHUNKSIZE)
+        _hash_range(
+            fh, hasher, bytearray(block_size), offset, CHUNKSIZE, watch
+        )
+
+    return hasher.digest()
+
+
+def _tree_hash(file, algo, block_size, workers, watch, on_chunk=None):
+    # Chunks are hashed in parallel, then the root hashes the file size
+    # and the chunk digests in order. hashlib and zlib release the GIL
+    # on large buffers, so the threads really overlap
+    size = os.path.getsize(file)
+    offsets = range(0, max(size, 1), CHUNKSIZE)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        digests = pool.map(
+            lambda offset: _hash_chunk(
+                file, algo, offset, block_size, watch
+            ),
+            offsets
+        )
+        root = ALGORITHMS[algo]()
+        root.update(size.to_bytes(8, "big"))
+        for index, digest in enumerate(digests):
+            root.update(digest)
+            if on_chunk is not None:
+                on_chunk(index, digest)
+
+    return root.hexdigest()
@@ -0,0 +1,92 @@
+import os
+import sqlite3
+from time import time
+from threading import Lock
+
+from scripts.hash import getHash
+from scripts.logger import VLCync_Logger
+
+
+class ClsHashCache:
+    FILE_NAME = "hash_cache.db"
+    MAX_ENTRIES = 2000
+
+    def __init__(self, directory, max_entries=MAX_ENTRIES):
+        self.logger = VLCync_Logger.get_logger('Client')
+        self.max_entries = int(max_entries)
+        self.lock = Lock()
+        # Hashing runs off the UI thread, the lock serialises access instead
+        self.db = sqlite3.connect(
+            os.path.join(directory, self.FILE_NAME), check_same_thread=False
+        )
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS digests ("
+                "path TEXT NOT NULL, algo TEXT NOT NULL, size INTEGER, "
+                "mtime_ns INTEGER, inode INTEGER, digest TEXT, "
+                "last_used REAL, PRIMARY KEY (path, algo))"
+            )
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS digests_last_used "
+                "ON digests (last_used)"
+            )
+
+    def get_hash(self, file, algo="crc32", *args, **kwargs):
+        # The file is stat'ed before hashing, so a write racing the hash
+        # leaves a stale key that simply misses next time
+        path = os.path.abspath(file)
+        stat = os.stat(path)
+        try:
+            digest = self.lookup(path, algo, stat)
+            if digest is not None:
+                self.logger.debug(f"Hash cache hit for {path}")
+                return digest
+
+        except sqlite3.Error as e:
+            self.logger.warning(f"Hash cache unavailable: {str(e)}")
+            return getHash(file, algo, *args, **kwargs)
+
+        digest = getHash(file, algo, *args, **kwargs)
+        try:
+            self.store(path, algo, stat, digest)
+
+        except sqlite3.Error as e:
+            self.logger.warning(f"Failed to cache hash: {str(e)}")
+
+        return digest
+
+    def lookup(self, path, algo, stat):
+        with self.lock, self.db:
+            row = self.db.execute(
+                "SELECT size, mtime_ns, inode, digest FROM digests "
+                "WHERE path = ? AND algo = ?", (path, algo)
+            ).fetchone()
+            if row is None or row[:3] != (
+                stat.st_size, stat.st_mtime_ns, stat.st_ino
+            ):
+                return None
+
+            self.db.execute(
+                "UPDATE digests SET last_used = ? "
+                "WHERE path = ? AND algo = ?", (time(), path, algo)
+            )
+            return row[3]
+
+    def store(self, path, algo, stat, digest):
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    path, algo, stat.st_size, stat.st_mtime_ns,
+                    stat.st_ino, digest, time()
+                )
+            )
+            self.db.execute(
+                "DELETE FROM digests WHERE rowid IN (SELECT rowid FROM "
+                "digests ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    def close(self):
+        with self.lock:
+            self.db.close()
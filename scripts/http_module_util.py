@@ -1,12 +1,12 @@
 import os
 import requests
-from requests.exceptions import ConnectTimeout
-from time import sleep
+from base64 import b64encode
+from requests.adapters import HTTPAdapter
+from time import perf_counter
 from urllib.parse import quote
-from threading import Thread
 from subprocess import Popen
 from scripts.vlc_util import ClsVLCUtil
-from scripts.logger import VLCync_Logger
+from scripts.vlc_status import ClsStatusReader
 from scripts.common_toolkit import ClsCommonToolkit as CTK
 
 
@@ -14,107 +14,44 @@ class HTTPmodule(ClsVLCUtil):
     TARG_ADDR = "127.0.0.1"
     TARG_PORT = 44500
     TIMEOUT = 1
-    STATUS_CHECK_INTERVAL = 0.75
-    DIFF_THRESHOLD = 1
+    RTT_SMOOTHING = 0.125
 
     def __init__(self, config, connection_handler) -> None:
-        self.logger = VLCync_Logger.get_logger('Client')
-        self.connection_handler = connection_handler
-        self.playback = False
-        self.playing = False
-        self.vlcdir = config.getValue("default", "vlcdir")
-        self.statThread = None
-        self.is_position_volatile = False
+        super().__init__(config, connection_handler)
+        self.session = None
+        self.rtt = None
         self._validate()
 
-    def outside_input(self, msg):
-        if "seek" in msg:
-            self.is_position_volatile = True
-            self.previous_time = int(msg.split(" ")[-1])
-            self._vlc_transceiver("seek", time=msg.split(" ")[-1])
-            self.is_position_volatile = False
+    def _launch(self, file_path):
+        self.session_token = CTK.generate_token()
+        # The media is loaded over HTTP once the interface is up
+        vlc_args = [
+            "--extraintf", "http",
+            "--http-host", self.TARG_ADDR,
+            "--http-port", str(self.TARG_PORT),
+            "--http-password", self.session_token,
+            "--start-paused"
+        ]
+
+        if os.name == "nt":
+            os.startfile(self.vlcdir, arguments=" ".join(vlc_args))
 
         else:
-            self.playing = not self.playing
-            self._vlc_transceiver("toggle_play")
-
-    def begin_playback(self, file_path):
-        if not self.playback:
-            self.session_token = CTK.generate_token()
-            vlc_args = " ".join([
-                "--extraintf http",
-                f"--http-host {self.TARG_ADDR}",
-                f"--http-port {self.TARG_PORT}",
-                f"--http-password {self.session_token}"
-            ])
-
-            if os.name == "nt":
-                os.startfile(self.vlcdir, arguments=vlc_args)
-
-            else:
-                Popen(["vlc", *file_path.split(), "--quiet"])
-
-            self.playback = True
-            self.playing = True
-            self._vlc_transceiver("begin", path=file_path)
-            sleep(2)
-            self._time_keeper()
-            self.statThread = Thread(
-                target=self._status_retriever, daemon=True
-            )
-            self.statThread.start()
-
-    def update_resume_point(self):
-        resp = self._vlc_transceiver()
-        self.connection_handler.send(f"CURRTIME {resp.get('time')}", False)
-
-    def _status_retriever(self):
-        while self.playback:
-            try:
-                response = self._vlc_transceiver()
-
-                self._parse(response)
-                sleep(self.STATUS_CHECK_INTERVAL)
-
-            except ConnectTimeout:
-                self.logger.info("VLC Client closed")
-                self.playback = False
-                self.connection_handler.disconnect()
-
-    def _parse(self, vlc_status):
-        t_keeper = self._time_keeper(int(vlc_status.get("time")))
-        self.logger.debug(f"{t_keeper=}")
-        pl_state = {
-            "playing": False,
-            "paused": True
-            }.get(vlc_status.get("state"))
-
-        if t_keeper is not None:
-            self.connection_handler.send(f"seek {t_keeper}", True)
-
-        if pl_state != self.playing:
-            self.connection_handler.send("toggle_play", True)
-            self.playing = not self.playing
-
-    def _time_keeper(self, time=None):
-        if time is None:
-            self.previous_time = 0
-            return
-
-        diff = abs(time-self.previous_time)
-        self.logger.debug(
-            f"{diff=} | {self.previous_time=} | {self.is_position_volatile=}"
-        )
+            Popen(["vlc", *vlc_args, "--quiet"])
 
-        if self.is_position_volatile:
-            return
+        self._open_session()
 
-        if diff <= 1 and diff >= 0:
-            self.previous_time = time
-            return
+    def _close_transport(self):
+        if self.session is not None:
+            self.session.close()
 
-        self.previous_time = time
-        return time
+    def _is_timeout(self, error):
+        # A refused connection also times out as ConnectTimeout, only a
+        # reply that never came counts as slow
+        return (
+            isinstance(error, requests.ReadTimeout) or
+            super()._is_timeout(error)
+        )
 
     def _query_parser(self, query, **kwargs):
         query_dict = {
@@ -123,7 +60,10 @@ class HTTPmodule(ClsVLCUtil):
                 f"{self._clean_path(kwargs.get('path', ''))}"
             ),
             "toggle_play": "pl_pause",
-            "seek": f"seek&val={kwargs.get('time')}"
+            "play": "pl_forceresume",
+            "pause": "pl_forcepause",
+            "seek": f"seek&val={kwargs.get('val')}",
+            "rate": f"rate&val={kwargs.get('val')}"
         }
         url = f"http://{self.TARG_ADDR}:{self.TARG_PORT}/requests/status.xml"
 
@@ -132,16 +72,38 @@ class HTTPmodule(ClsVLCUtil):
 
         return f'{url}{quote(f"?command={query_dict.get(query)}", safe="?=&")}'
 
+    def _open_session(self):
+        # One keep-alive connection to VLC reused by every poll and command,
+        # with the Basic auth header computed once instead of per request
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(
+            pool_connections=1, pool_maxsize=4
+        ))
+        self.session.headers["Authorization"] = "Basic " + b64encode(
+            f":{self.session_token}".encode('utf-8')
+        ).decode('utf-8')
+        self._urls = {
+            query: self._query_parser(query) for query in (None, "toggle_play")
+        }
+
     def _vlc_transceiver(self, query=None, **kwargs):
-        url_encoded_query = self._query_parser(query, **kwargs)
-        response = CTK.parse_xml(requests.get(
-            url_encoded_query,
-            auth=("", self.session_token),
-            timeout=self.TIMEOUT
-            ).content)
-
-        self.logger.debug(
-            f"{response.get('state')=} | {response.get('time')=}"
+        url_encoded_query = self._urls.get(query)
+        if url_encoded_query is None:
+            url_encoded_query = self._query_parser(query, **kwargs)
+
+        start = perf_counter()
+        content = self.session.get(
+            url_encoded_query, timeout=self.TIMEOUT
+        ).content
+        rtt = perf_counter() - start
+        self.rtt = rtt if self.rtt is None else (
+            self.rtt + self.RTT_SMOOTHING * (rtt - self.rtt)
+        )
+
+        response = ClsStatusReader.parse(content)
+        self.logger.debug_every(
+            self.LOG_INTERVAL, "state=%s | time=%s | rtt=%.1fms",
+            response.get('state'), response.get('time'), rtt * 1000
         )
         return response
 
@@ -1,23 +1,91 @@
+import atexit
 import logging
-from logging.handlers import RotatingFileHandler
+from queue import SimpleQueue
+from threading import Lock
+from time import monotonic
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+
+
+class ClsLogAdapter(logging.LoggerAdapter):
+    def __init__(self, logger, extra):
+        super().__init__(logger, extra)
+        self.lock = Lock()
+        self.sampled = {}
+
+    def debug_every(self, interval, msg, *args):
+        # For per-poll events: at most one record per interval for each
+        # message template, noting how many were skipped in between
+        if not self.isEnabledFor(logging.DEBUG):
+            return
+
+        now = monotonic()
+        with self.lock:
+            last, skipped = self.sampled.get(msg, (None, 0))
+            if last is not None and now - last < interval:
+                self.sampled[msg] = (last, skipped + 1)
+                return
+            self.sampled[msg] = (now, 0)
+
+        if skipped:
+            self.debug(f"{msg} (+%d skipped)", *args, skipped)
+        else:
+            self.debug(msg, *args)
 
 
 class VLCync_Logger:
+    ROOT = 'VLCync'
+    LEVEL = "INFO"
+    MAX_BYTES = 5 * 2**20
+    BACKUP_COUNT = 3
+    listener = None
+
+    @staticmethod
+    def configure(config=None, name="Client"):
+        # Handlers run on the listener's thread, so the poller and the
+        # receiver only ever pay for putting a record on a queue
+        if VLCync_Logger.listener is not None:
+            return
+
+        def option(key, default):
+            if config is None:
+                return default
+            return config.get_value("logging", key, default)
+
+        root = logging.getLogger(VLCync_Logger.ROOT)
+        root.propagate = False
+        root.setLevel(option("level", VLCync_Logger.LEVEL).upper())
+        # Per subsystem overrides, e.g. "level.player = DEBUG" in [logging]
+        if config is not None and config.config.has_section("logging"):
+            for key, value in config.config.items("logging"):
+                if key.startswith("level."):
+                    logging.getLogger(
+                        f"{VLCync_Logger.ROOT}.{key[len('level.'):].title()}"
+                    ).setLevel(value.upper())
+
+        form = logging.Formatter(
+            '%(name)s| %(asctime)s | %(levelname)-5s: %(message)s'
+        )
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(form)
+        file_handler = RotatingFileHandler(
+            f"VLCync_{name}.log",
+            maxBytes=int(option("maxbytes", VLCync_Logger.MAX_BYTES)),
+            backupCount=int(option("backupcount", VLCync_Logger.BACKUP_COUNT))
+        )
+        file_handler.setFormatter(form)
+
+        queue = SimpleQueue()
+        root.addHandler(QueueHandler(queue))
+        VLCync_Logger.listener = QueueListener(
+            queue, console_handler, file_handler, respect_handler_level=True
+        )
+        VLCync_Logger.listener.start()
+        atexit.register(VLCync_Logger.listener.stop)
+
     @staticmethod
-    def get_logger(type: str) ->logging.Logger:
-        logger = logging.getLogger('VLCync')
-        logger.propagate=False
-        logger.setLevel(logging.DEBUG)
-        form = logging.Formatter('%(name)s-%(type)s| %(asctime)s | %(levelname)-5s: %(message)s')
-        if not logger.hasHandlers():
-            console_handler = logging.StreamHandler()
-            console_handler.setLevel(logging.DEBUG)
-            console_handler.setFormatter(form)
-            logger.addHandler(console_handler)
-
-            file_handler = RotatingFileHandler(f"VLCync_{type}.log", backupCount=3)
-            file_handler.setLevel(logging.DEBUG)
-            file_handler.setFormatter(form)
-            logger.addHandler(file_handler)
-
-        return logging.LoggerAdapter(logger, extra={"type": type})
\ No newline at end of file
+    def get_logger(type: str) -> ClsLogAdapter:
+        # Modules used before configure() (benchmarks, the fake server) get
+        # the defaults, logging to a file named after their subsystem
+        VLCync_Logger.configure(name=type)
+        logger = logging.getLogger(f"{VLCync_Logger.ROOT}.{type}")
+        return ClsLogAdapter(logger, extra={"type": type})
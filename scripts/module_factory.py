@@ -2,9 +2,10 @@ class ClsModuleFactory:
     @staticmethod
     def get_module(config, connection_handler):
         module = {
-            "http": ClsModuleFactory.http_module
+            "http": ClsModuleFactory.http_module,
+            "rc": ClsModuleFactory.rc_module
         }.get(
-            config.getValue("default", "module"),
+            config.get_value("default", "module", "http"),
             ClsModuleFactory.http_module
         )
 
@@ -14,3 +15,8 @@ class ClsModuleFactory:
     def http_module(config, connection_handler):
         from scripts.http_module_util import HTTPmodule
         return HTTPmodule(config, connection_handler)
+
+    @staticmethod
+    def rc_module(config, connection_handler):
+        from scripts.rc_module_util import RCmodule
+        return RCmodule(config, connection_handler)
@@ -0,0 +1,70 @@
+from time import monotonic
+
+
+class ClsPollScheduler:
+    # Seconds between status polls in each phase
+    FAST_INTERVAL = 0.15
+    NORMAL_INTERVAL = 0.75
+    STABLE_INTERVAL = 1.5
+    PAUSED_INTERVAL = 2.5
+    # How long to keep polling fast after a command or a surprise
+    FAST_WINDOW = 2
+    # Consecutive unremarkable polls before backing off
+    STABLE_POLLS = 8
+
+    def __init__(self, clock=monotonic):
+        self.clock = clock
+        self.polls = 0
+        self.reset()
+
+    def reset(self):
+        self.fast_until = 0
+        self.stable = 0
+        self.last_time = None
+        self.last_seen = None
+        self.playing = False
+        self.rate = 1.0
+
+    def nudge(self):
+        self.fast_until = self.clock() + self.FAST_WINDOW
+        self.stable = 0
+
+    def anchor(self, time=None, playing=None, rate=None):
+        # Without a time the current prediction becomes the new baseline,
+        # used when a command changes the play state or rate
+        if time is None:
+            time = self.predict()
+
+        if time is not None:
+            self.last_time = time
+            self.last_seen = self.clock()
+        if playing is not None:
+            self.playing = playing
+        if rate is not None:
+            self.rate = rate
+
+    def observe(self, time, playing, rate, surprising):
+        self.polls += 1
+        self.anchor(time, playing, rate)
+        if surprising:
+            self.nudge()
+        else:
+            self.stable += 1
+
+    def predict(self):
+        if self.last_time is None:
+            return None
+
+        if not self.playing:
+            return self.last_time
+
+        return self.last_time + (self.clock() - self.last_seen) * self.rate
+
+    def interval(self):
+        if self.clock() < self.fast_until:
+            return self.FAST_INTERVAL
+
+        if self.stable < self.STABLE_POLLS:
+            return self.NORMAL_INTERVAL
+
+        return self.STABLE_INTERVAL if self.playing else self.PAUSED_INTERVAL
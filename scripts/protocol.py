@@ -0,0 +1,118 @@
+from enum import IntEnum
+
+
+class Opcode(IntEnum):
+    CHAT = 0
+    TOGGLE_PLAY = 1
+    PLAY = 2
+    PAUSE = 3
+    SEEK = 4
+    CURRTIME = 5
+    VOTE = 6
+    UNVOTE = 7
+    HASH_MATCH = 8
+    HASH_MISMATCH = 9
+    HASH_RESET = 10
+    ALL_VOTED = 11
+    PING = 12
+    PONG = 13
+    POSITION = 14
+    START_AT = 15
+    STARTED = 16
+    VERIFY = 17
+    HASH_RANK = 18
+
+
+# opcode -> (for_vlc, legacy text understood by older peers and the server)
+# Time arguments travel in milliseconds, the legacy text keeps seconds.
+# PLAY/PAUSE optionally carry the sender's position. START_AT/STARTED carry
+# server clock timestamps in milliseconds
+COMMANDS = {
+    Opcode.TOGGLE_PLAY: (True, lambda: "toggle_play"),
+    Opcode.PLAY: (True, lambda *position: "toggle_play"),
+    Opcode.PAUSE: (True, lambda *position: "toggle_play"),
+    Opcode.SEEK: (True, lambda ms: f"seek {ms // 1000}"),
+    Opcode.CURRTIME: (False, lambda ms: f"CURRTIME {ms // 1000}"),
+    Opcode.VOTE: (False, lambda: "VOTE"),
+    Opcode.UNVOTE: (False, lambda: "UNVOTE"),
+    Opcode.PING: (False, lambda t0: f"PING {t0}"),
+    Opcode.POSITION: (True, lambda ms: f"POSITION {ms // 1000}"),
+    Opcode.START_AT: (False, lambda ms: f"START_AT {ms}"),
+    Opcode.STARTED: (False, lambda ms: f"STARTED {ms}"),
+    Opcode.VERIFY: (False, lambda stage, value: f"VERIFY {stage} {value}"),
+    # Hash algorithm ids, fastest first on the sender's machine
+    Opcode.HASH_RANK: (
+        False, lambda *ids: f"HASH_RANK {','.join(map(str, ids))}"
+    )
+}
+
+SYNC_WORDS = {
+    "toggle_play": Opcode.TOGGLE_PLAY,
+    "seek": Opcode.SEEK
+}
+
+SERVER_MESSAGES = {
+    "HASHES MATCH": Opcode.HASH_MATCH,
+    "HASHES DO NOT MATCH": Opcode.HASH_MISMATCH,
+    "HASH BOOL RESET": Opcode.HASH_RESET,
+    "EVERYONE HAS VOTED": Opcode.ALL_VOTED
+}
+
+
+def to_text(opcode, *args):
+    return COMMANDS[opcode][1](*args)
+
+
+def is_for_vlc(opcode):
+    return COMMANDS[opcode][0]
+
+
+def parse_text(msg, forVLC):
+    # Fallback for packets without an opcode, i.e. from older clients or the
+    # server. Sync text must match exactly so chat never triggers a command
+    if msg is None:
+        return Opcode.CHAT, ()
+
+    if forVLC:
+        word, _, arg = msg.partition(" ")
+        opcode = SYNC_WORDS.get(word)
+        if opcode is Opcode.TOGGLE_PLAY and not len(arg):
+            return opcode, ()
+
+        if opcode is Opcode.SEEK and arg.isdigit():
+            return opcode, (int(arg) * 1000,)
+
+        return Opcode.CHAT, ()
+
+    opcode = SERVER_MESSAGES.get(msg.strip())
+    if opcode is not None:
+        return opcode, ()
+
+    if msg.isupper():
+        for phrase, opcode in SERVER_MESSAGES.items():
+            if phrase in msg:
+                return opcode, ()
+
+    return Opcode.CHAT, ()
+
+
+class ClsDispatcher:
+    def __init__(self, fallback=None):
+        self.handlers = {}
+        self.fallback = fallback
+
+    def register(self, opcode, handler):
+        self.handlers[opcode] = handler
+
+    def dispatch(self, packet):
+        opcode, args = packet.opcode, packet.args
+        if opcode is None:
+            opcode, args = parse_text(packet.message, packet.forVLC)
+
+        handler = self.handlers.get(opcode)
+        if handler is None:
+            if self.fallback is not None:
+                self.fallback(packet)
+            return
+
+        handler(packet, *args)
@@ -0,0 +1,157 @@
+import os
+import socket
+from subprocess import Popen
+from scripts.vlc_util import ClsVLCUtil
+
+
+class RCmodule(ClsVLCUtil):
+    TARG_ADDR = "127.0.0.1"
+    TARG_PORT = 44500
+    TIMEOUT = 1
+    RECV_SIZE = 4096
+    # The rc interface ends every reply with a prompt at the start of a line
+    PROMPT = b"> "
+    STATUS_QUERIES = ("status", "get_time", "get_length")
+
+    def __init__(self, config, connection_handler) -> None:
+        super().__init__(config, connection_handler)
+        self.sock = None
+        self.buffer = bytearray()
+        self._validate()
+
+    def _launch(self, file_path):
+        vlc_args = [
+            "--extraintf", "rc",
+            "--rc-host", f"{self.TARG_ADDR}:{self.TARG_PORT}",
+            "--start-paused"
+        ]
+
+        if os.name == "nt":
+            os.startfile(
+                self.vlcdir, arguments=" ".join([*vlc_args, "--rc-quiet"])
+            )
+
+        else:
+            Popen(["vlc", *vlc_args, "--quiet"])
+
+    def _open_session(self):
+        self.sock = socket.create_connection(
+            (self.TARG_ADDR, self.TARG_PORT), timeout=self.TIMEOUT
+        )
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer.clear()
+        try:
+            # Discard the greeting banner
+            self._read_replies(1)
+
+        except OSError:
+            self._close_transport()
+            raise
+
+    def _close_transport(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def _query_parser(self, query, **kwargs):
+        return {
+            "begin": f"add {kwargs.get('path', '')}",
+            "toggle_play": "pause",
+            "play": "play",
+            "pause": "pause",
+            "seek": f"seek {kwargs.get('val')}",
+            "rate": f"rate {kwargs.get('val')}"
+        }.get(query)
+
+    def _vlc_transceiver(self, query=None, **kwargs):
+        # Connects lazily, so the readiness probe covers VLC starting up
+        if self.sock is None:
+            self._open_session()
+
+        if query == "pause":
+            # rc only has a toggle, so pausing is made idempotent by
+            # checking the state first
+            status, = self._exchange("status")
+            if self._parse_state(status) != "playing":
+                return {}
+
+        if query is not None:
+            self._exchange(self._query_parser(query, **kwargs))
+            return {}
+
+        status, time, length = self._exchange(*self.STATUS_QUERIES)
+        response = {
+            "state": self._parse_state(status),
+            "time": self._parse_int(time),
+            "length": self._parse_int(length),
+            "rate": self.scheduler.rate
+        }
+        self.logger.debug_every(
+            self.LOG_INTERVAL, "state=%s | time=%s",
+            response.get('state'), response.get('time')
+        )
+        return response
+
+    def _exchange(self, *commands):
+        # All commands go out in one write and the replies are read back
+        # in order, so a status poll costs a single round trip
+        try:
+            self.sock.sendall("".join(
+                f"{command}\n" for command in commands
+            ).encode("utf-8"))
+            return self._read_replies(len(commands))
+
+        except OSError:
+            # A half read reply would desync the framing, start over
+            self._close_transport()
+            raise
+
+    def _read_replies(self, count):
+        replies = []
+        while len(replies) < count:
+            end = self._find_prompt()
+            if end is None:
+                received = self.sock.recv(self.RECV_SIZE)
+                if not received:
+                    raise ConnectionResetError("VLC closed the rc interface")
+                self.buffer += received
+                continue
+
+            replies.append(
+                self.buffer[:end].decode("utf-8", errors="replace")
+            )
+            del self.buffer[:end + len(self.PROMPT)]
+
+        return replies
+
+    def _find_prompt(self):
+        index = 0
+        while True:
+            index = self.buffer.find(self.PROMPT, index)
+            if index == -1:
+                return None
+
+            if index == 0 or self.buffer[index - 1] in b"\r\n":
+                return index
+
+            index += 1
+
+    @staticmethod
+    def _parse_state(reply):
+        # Asynchronous "( status change: ... )" notices share the stream,
+        # the status reply itself carries "( state playing )"
+        for line in reply.splitlines():
+            line = line.strip("() \t")
+            if line.startswith("state "):
+                return line.split()[-1]
+
+        return None
+
+    @staticmethod
+    def _parse_int(reply):
+        for line in reversed(reply.splitlines()):
+            line = line.strip()
+            if line.isdigit():
+                return int(line)
+
+        return 0
@@ -0,0 +1,59 @@
+from threading import Lock
+
+
+class ClsStagedVerifier:
+    # Stage values compared between peers before the full hash is done.
+    # Stage 0 is the file size, stage 1 the sampled fingerprint and every
+    # later stage the digest of the next tree chunk, in file order
+    SIZE = 0
+    SAMPLE = 1
+    FIRST_CHUNK = 2
+
+    def __init__(self):
+        self.lock = Lock()
+        self.local = {}
+        self.peers = {}
+        self.mismatched = set()
+
+    @staticmethod
+    def fold(digest):
+        # Stage values travel as signed 64 bit command arguments
+        if isinstance(digest, str):
+            digest = bytes.fromhex(digest.rpartition(":")[2])
+        return int.from_bytes(digest[:8], "big", signed=True)
+
+    def reset(self):
+        with self.lock:
+            self.local.clear()
+            self.mismatched.clear()
+
+    def add_local(self, stage, value):
+        # Returns the peers this stage proves to hold a different file
+        with self.lock:
+            self.local[stage] = value
+            return [
+                username for username, stages in self.peers.items()
+                if self._differs(username, stage, stages.get(stage))
+            ]
+
+    def add_peer(self, username, stage, value):
+        # Returns True the first time the peer is found to differ
+        with self.lock:
+            if stage == self.SIZE:
+                # A new size announcement means the peer picked a file
+                self.peers[username] = {}
+                self.mismatched.discard(username)
+
+            self.peers.setdefault(username, {})[stage] = value
+            return self._differs(username, stage, value)
+
+    def _differs(self, username, stage, value):
+        local = self.local.get(stage)
+        if (
+            local is None or value is None or local == value or
+            username in self.mismatched
+        ):
+            return False
+
+        self.mismatched.add(username)
+        return True
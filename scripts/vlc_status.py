@@ -0,0 +1,61 @@
+from xml.parsers import expat
+
+
+class _StatusComplete(Exception):
+    pass
+
+
+class ClsStatusReader:
+    # Top level status.xml fields the sync logic reads, with their types
+    FIELDS = {
+        "time": int,
+        "length": int,
+        "position": float,
+        "state": str,
+        "rate": float
+    }
+
+    @staticmethod
+    def parse(xml):
+        status = {}
+        depth = 0
+        current = None
+        text = []
+
+        def start(name, attrs):
+            nonlocal depth, current
+            depth += 1
+            if depth == 2 and name in ClsStatusReader.FIELDS:
+                current = name
+                text.clear()
+
+        def end(name):
+            nonlocal depth, current
+            depth -= 1
+            if current is None or depth != 1:
+                return
+
+            value = "".join(text).strip()
+            if len(value):
+                status[current] = ClsStatusReader.FIELDS[current](value)
+            current = None
+
+            # VLC emits these before the information and stats trees, so
+            # there is no need to read the rest of the document
+            if len(status) == len(ClsStatusReader.FIELDS):
+                raise _StatusComplete()
+
+        def chars(data):
+            if current is not None:
+                text.append(data)
+
+        parser = expat.ParserCreate()
+        parser.StartElementHandler = start
+        parser.EndElementHandler = end
+        parser.CharacterDataHandler = chars
+        try:
+            parser.Parse(xml, True)
+        except _StatusComplete:
+            pass
+
+        return status
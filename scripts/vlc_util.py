@@ -1,28 +1,576 @@
 from abc import ABC, abstractmethod
+from enum import Enum
+from queue import SimpleQueue, Empty
+from threading import Thread
+from time import sleep, monotonic
 import ctypes
 import os
 
+from scripts.logger import VLCync_Logger
+from scripts.protocol import Opcode
+from scripts.com_packet import CommPacket
+from scripts.poll_scheduler import ClsPollScheduler
+from scripts.drift_control import ClsDriftController
+from scripts.echo_guard import ClsEchoGuard
+
+
+class PlayerState(Enum):
+    IDLE = "idle"
+    STARTING = "starting"
+    # VLC is up with the media loaded, paused at the start
+    READY = "ready"
+    PLAYING = "playing"
+    PAUSED = "paused"
+
 
 class ClsVLCUtil(ABC):
-    @abstractmethod
+    DIFF_THRESHOLD = 1
+    # Remote positions closer than this to ours are left alone
+    SYNC_TOLERANCE = 0.2
+    # Position beacons feeding the drift controller, and their shelf life
+    BEACON_INTERVAL = 5
+    PEER_TIMEOUT = 15
+    # Quiet time after the last local seek before it is broadcast
+    SEEK_DEBOUNCE = 0.4
+    # Readiness probe backoff while VLC starts up and loads the media
+    READY_TIMEOUT = 20
+    PROBE_BASE_DELAY = 0.05
+    PROBE_MAX_DELAY = 1
+    # How far ahead (ms) a synchronized start is proposed, and how early
+    # (s) the actor wakes to spin on the clock for the final stretch
+    START_LEAD = 1500
+    START_SPIN = 0.02
+    # Per-poll debug records are sampled to one per this many seconds
+    LOG_INTERVAL = 5
+    # Timed out exchanges tolerated in a row before VLC is taken as closed
+    MAX_TIMEOUTS = 3
+
+    TRANSITIONS = {
+        PlayerState.IDLE: (PlayerState.STARTING,),
+        PlayerState.STARTING: (PlayerState.READY, PlayerState.IDLE),
+        PlayerState.READY: (
+            PlayerState.STARTING, PlayerState.PLAYING, PlayerState.IDLE
+        ),
+        PlayerState.PLAYING: (PlayerState.PAUSED, PlayerState.IDLE),
+        PlayerState.PAUSED: (PlayerState.PLAYING, PlayerState.IDLE)
+    }
+
+    def __init__(self, config, connection_handler, clock=monotonic):
+        self.logger = VLCync_Logger.get_logger('Player')
+        self.clock = clock
+        self.connection_handler = connection_handler
+        self.vlcdir = config.get_value("default", "vlcdir")
+        self.state = PlayerState.IDLE
+        self.media = None
+        self.readyTimeout = float(config.get_value(
+            "default", "vlcreadytimeout", self.READY_TIMEOUT
+        ))
+        self.startLead = int(config.get_value(
+            "default", "startlead", self.START_LEAD
+        ))
+        # Agreed start time on the server clock, and when we really started
+        self.start_at = None
+        self.started_at = None
+        self.peer_starts = {}
+        self.length = 0
+        self.scheduler = ClsPollScheduler(clock)
+        self.drift = ClsDriftController(float(config.get_value(
+            "default", "driftseekthreshold", ClsDriftController.SEEK_THRESHOLD
+        )))
+        self.peer_positions = {}
+        self.last_beacon = 0
+        self.echo = ClsEchoGuard(clock)
+        self.pending_seek = None
+        self.timeouts = 0
+        self.last_poll = 0
+
+        # Every state change happens on the actor thread, other threads
+        # only post (handler, args) events to the inbox
+        self.inbox = SimpleQueue()
+        self.actorThread = Thread(target=self._run, daemon=True)
+        self.actorThread.start()
+
+    @property
+    def playback(self):
+        return self.state in (PlayerState.PLAYING, PlayerState.PAUSED)
+
+    @property
+    def playing(self):
+        return self.state is PlayerState.PLAYING
+
+    def post(self, handler, *args):
+        self.inbox.put((handler, args))
+
+    def register_handlers(self, dispatcher):
+        for opcode, handler in (
+            (Opcode.SEEK, self._remote_seek),
+            (Opcode.TOGGLE_PLAY, self._remote_toggle),
+            (Opcode.PLAY, self._remote_play),
+            (Opcode.PAUSE, self._remote_pause),
+            (Opcode.POSITION, self._remote_position),
+            (Opcode.START_AT, self._remote_start_at),
+            (Opcode.STARTED, self._remote_started)
+        ):
+            dispatcher.register(
+                opcode,
+                lambda packet, *args, handler=handler:
+                    self.post(handler, packet, *args)
+            )
+
+    def prepare(self, file_path):
+        self.post(self._prepare, file_path)
+
     def begin_playback(self, file_path):
-        pass
+        self.post(self._begin, file_path)
 
-    def outside_input(self, msg):
-        pass
+    def update_resume_point(self):
+        self.post(self._update_resume_point)
 
     @abstractmethod
-    def _parse(self, msg):
+    def _launch(self, file_path):
         pass
 
     @abstractmethod
-    def _status_retriever(self):
+    def _vlc_transceiver(self, query=None, **kwargs):
         pass
 
-    @abstractmethod
-    def _vlc_transceiver(self, msg):
+    def _close_transport(self):
         pass
 
+    def _is_timeout(self, error):
+        return isinstance(error, TimeoutError)
+
+    def _run(self):
+        while True:
+            self._step()
+
+    def _step(self):
+        # A due poll or start runs first, so a steady stream of events
+        # cannot starve it
+        timeout = self._next_timeout()
+        handler = None
+        if timeout != 0:
+            try:
+                handler, args = self.inbox.get(timeout=timeout)
+            except Empty:
+                pass
+
+        if handler is None:
+            handler, args = (
+                self._start if self._start_pending() else self._poll
+            ), ()
+
+        try:
+            handler(*args)
+
+        except OSError as e:
+            if not self.playback:
+                self.logger.error(f"VLC unreachable: {str(e)}")
+                self._shutdown()
+                return
+
+            # A slow reply is a failed poll, not a closed player
+            self.timeouts += 1
+            if self._is_timeout(e) and self.timeouts < self.MAX_TIMEOUTS:
+                self.logger.warning(f"VLC did not answer: {str(e)}")
+                return
+
+            self.timeouts = 0
+            self.logger.info("VLC Client closed")
+            self._shutdown()
+            self.connection_handler.disconnect()
+
+        except Exception as e:
+            self.logger.exception(e)
+
+    def _start_pending(self):
+        return self.start_at is not None and self.state is PlayerState.READY
+
+    def _next_timeout(self):
+        if self._start_pending():
+            remaining = (
+                self.start_at - self.connection_handler.clock.now()
+            ) / 1000
+            return max(0, remaining - self.START_SPIN)
+
+        if not self.playback:
+            return None
+
+        # Measured from the last poll, events in between do not push it back
+        return max(
+            0, self.last_poll + self.scheduler.interval() - self.clock()
+        )
+
+    def _transition(self, state):
+        if state is self.state:
+            return True
+
+        if state not in self.TRANSITIONS[self.state]:
+            self.logger.warning(
+                f"Ignored player transition {self.state.value} -> "
+                f"{state.value}"
+            )
+            return False
+
+        self.logger.debug(f"Player {self.state.value} -> {state.value}")
+        self.state = state
+        return True
+
+    def _shutdown(self):
+        self._transition(PlayerState.IDLE)
+        self.media = None
+        self.start_at = None
+        self.started_at = None
+        self.peer_starts.clear()
+        self._close_transport()
+
+    def _probe(self, ready):
+        # Polls VLC with exponential backoff until ready(status) holds,
+        # connection errors just mean it is not listening yet
+        delay = self.PROBE_BASE_DELAY
+        deadline = monotonic() + self.readyTimeout
+        while True:
+            try:
+                status = self._vlc_transceiver()
+                if ready(status):
+                    return status
+
+            except OSError as e:
+                if monotonic() > deadline:
+                    raise TimeoutError(
+                        f"VLC not ready after {self.readyTimeout}s"
+                    ) from e
+
+            if monotonic() > deadline:
+                raise TimeoutError(f"VLC not ready after {self.readyTimeout}s")
+
+            sleep(delay)
+            delay = min(delay * 2, self.PROBE_MAX_DELAY)
+
+    def _prepare(self, file_path):
+        # Launches VLC and loads the media paused at the start, so begin
+        # only has to resume it
+        if self.playback or self.media == file_path:
+            return
+
+        launched = self.state is PlayerState.READY
+        if not self._transition(PlayerState.STARTING):
+            return
+
+        if not launched:
+            self._launch(file_path)
+            self._probe(lambda status: True)
+
+        self._vlc_transceiver("begin", path=file_path)
+        status = self._probe(lambda status: status.get("length", 0) > 0)
+        if status.get("state") == "playing":
+            self._vlc_transceiver("pause")
+            self._vlc_transceiver("seek", val=0)
+
+        self.length = status.get("length", 0)
+        self.media = file_path
+        self._transition(PlayerState.READY)
+        self.logger.info(f"VLC ready with {file_path}")
+
+    def _begin(self, file_path):
+        if self.state is PlayerState.READY and self.media == file_path:
+            try:
+                self._vlc_transceiver()
+
+            except OSError:
+                self.logger.warning("Preloaded VLC went away, relaunching")
+                self._shutdown()
+
+        self._prepare(file_path)
+        if self.state is not PlayerState.READY:
+            return
+
+        # Without a shared clock there is nothing to schedule against
+        if "CLOCK" not in self.connection_handler.capabilities:
+            self._start()
+            return
+
+        # A peer got here first, join its schedule rather than pushing it
+        # back. Should it have passed already, _start catches up
+        if self.start_at is not None:
+            return
+
+        # Every peer proposes a start and all of them settle on the latest
+        # proposal, which keeps a slow peer from being left behind
+        proposal = self.connection_handler.clock.now() + self.startLead
+        self.connection_handler.send_command(Opcode.START_AT, proposal)
+        self._schedule_start(proposal)
+
+    def _schedule_start(self, start_at):
+        if self.start_at is None or start_at > self.start_at:
+            self.start_at = start_at
+            self.logger.debug(f"Start scheduled at {start_at}")
+
+    def _start(self):
+        clock = self.connection_handler.clock
+        start_at, self.start_at = self.start_at, None
+        if start_at is not None:
+            while clock.now() < start_at:
+                pass
+
+        self._vlc_transceiver("play")
+        self.started_at = clock.now()
+        late_ms = 0 if start_at is None else self.started_at - start_at
+
+        self._time_keeper()
+        self.scheduler.anchor(0, playing=True)
+        self.scheduler.nudge()
+        self._transition(PlayerState.PLAYING)
+        if late_ms / 1000 > self.SYNC_TOLERANCE:
+            # Prepared too late, catch up with the peers that started on time
+            self._seek(late_ms, "start")
+
+        self.logger.info(f"Playback started {late_ms} ms after schedule")
+        if start_at is not None:
+            self.connection_handler.send_command(
+                Opcode.STARTED, self.started_at
+            )
+        for username in list(self.peer_starts):
+            self._log_start_skew(username)
+
+    def _remote_start_at(self, packet, start_at):
+        if self.playback:
+            self.logger.warning(
+                f"Start proposal from {packet.username} arrived after "
+                "playback began"
+            )
+            return
+
+        self._schedule_start(start_at)
+
+    def _remote_started(self, packet, started_at):
+        self.peer_starts[packet.username] = started_at
+        if self.started_at is not None:
+            self._log_start_skew(packet.username)
+
+    def _log_start_skew(self, username):
+        skew = self.peer_starts.pop(username) - self.started_at
+        self.logger.info(f"Start skew vs {username}: {skew:+} ms")
+
+    def _update_resume_point(self):
+        time = self.scheduler.predict()
+        if time is None:
+            time = self._vlc_transceiver().get('time', 0)
+
+        self.connection_handler.send_command(Opcode.CURRTIME, int(time * 1000))
+
+    def _remote_seek(self, packet, time_ms):
+        if not self.playback:
+            return
+
+        # A playing sender has moved on while the command was in flight
+        if self.playing:
+            time_ms += self.connection_handler.clock.one_way_delay(
+                packet.sent_at
+            )
+        self._seek(time_ms, CommPacket.origin(packet))
+
+    def _remote_toggle(self, packet):
+        if self.state is PlayerState.PLAYING:
+            self._remote_pause(packet)
+        elif self.state is PlayerState.PAUSED:
+            self._remote_play(packet)
+
+    def _remote_play(self, packet, position_ms=None):
+        if self.state is PlayerState.PAUSED:
+            self._apply_state(PlayerState.PLAYING, packet)
+
+        if position_ms is not None and self.playback:
+            clock = self.connection_handler.clock
+            self._align(
+                position_ms + clock.one_way_delay(packet.sent_at),
+                CommPacket.origin(packet)
+            )
+
+    def _remote_pause(self, packet, position_ms=None):
+        if self.state is PlayerState.PLAYING:
+            self._apply_state(PlayerState.PAUSED, packet)
+        self._set_rate(1.0)
+
+        if position_ms is not None and self.playback:
+            self._align(position_ms, CommPacket.origin(packet))
+
+    def _apply_state(self, state, packet):
+        self._transition(state)
+        self.echo.expect("state", self.playing, CommPacket.origin(packet))
+        self.scheduler.anchor(playing=self.playing)
+        self.scheduler.nudge()
+        # Forced rather than toggled, so a stale view of VLC's state can
+        # not invert playback
+        self._vlc_transceiver("play" if self.playing else "pause")
+
+    def _remote_position(self, packet, position_ms):
+        now = self.clock()
+        delay = self.connection_handler.clock.one_way_delay(packet.sent_at)
+        self.peer_positions[packet.username] = (
+            (position_ms + delay) / 1000, now
+        )
+
+        position = self.scheduler.predict()
+        if not self.playing or position is None:
+            return
+
+        references = [
+            peer_position + (now - seen)
+            for peer_position, seen in self.peer_positions.values()
+            if now - seen < self.PEER_TIMEOUT
+        ]
+        reference = sum(references) / len(references)
+        rate = self.drift.update(position - reference)
+        self.logger.debug_every(
+            self.LOG_INTERVAL, "drift=%.3f | rate=%s | peers=%d",
+            position - reference, rate, len(references)
+        )
+
+        if rate is None:
+            self._seek(int(reference * 1000), CommPacket.origin(packet))
+            self._set_rate(1.0)
+            return
+
+        self._set_rate(rate)
+
+    def _set_rate(self, rate):
+        if rate == self.scheduler.rate or not self.playback:
+            return
+
+        self._vlc_transceiver("rate", val=rate)
+        self.scheduler.anchor(rate=rate)
+
+    def _beacon(self, time):
+        now = self.clock()
+        if (
+            not self.playing or
+            now - self.last_beacon < self.BEACON_INTERVAL or
+            "BEACON" not in self.connection_handler.capabilities
+        ):
+            return
+
+        self.last_beacon = now
+        self.connection_handler.send_command(
+            Opcode.POSITION, int(time * 1000)
+        )
+
+    def _align(self, position_ms, origin):
+        expected = self.scheduler.predict()
+        if (
+            expected is None or
+            abs(expected - position_ms / 1000) > self.SYNC_TOLERANCE
+        ):
+            self._seek(position_ms, origin)
+
+    def _seek(self, time_ms, origin):
+        self.echo.expect("seek", time_ms / 1000, origin)
+        self.scheduler.anchor(time_ms / 1000)
+        self.scheduler.nudge()
+        # VLC only takes whole seconds, but a percentage of the length
+        # is a float, which gets us millisecond placement
+        if self.length:
+            val = f"{time_ms / (self.length * 10):.6f}%"
+        else:
+            val = time_ms // 1000
+        self._vlc_transceiver("seek", val=val)
+
+    def _poll(self):
+        self.last_poll = self.clock()
+        status = self._vlc_transceiver()
+        self.timeouts = 0
+        self._parse(status)
+
+    def _position(self, vlc_status):
+        # time is whole seconds, position * length has sub-second precision
+        self.length = vlc_status.get("length", 0)
+        position = vlc_status.get("position")
+        if self.length and position is not None:
+            return position * self.length
+
+        return vlc_status.get("time", 0)
+
+    def _parse(self, vlc_status):
+        time = self._position(vlc_status)
+        pl_state = {
+            "playing": True,
+            "paused": False
+            }.get(vlc_status.get("state"))
+        state_changed = pl_state is not None and pl_state != self.playing
+
+        # The prediction still assumes the old play state, and the PLAY or
+        # PAUSE sent below carries the position anyway
+        t_keeper = None if state_changed else self._time_keeper(time)
+        self.logger.debug_every(self.LOG_INTERVAL, "t_keeper=%s", t_keeper)
+
+        # Swallow changes caused by remote commands we applied ourselves
+        origin = self.echo.filter("seek", time)
+        if t_keeper is not None and origin is not None:
+            self.logger.debug(f"Suppressed seek echo of {origin}")
+            t_keeper = None
+
+        origin = self.echo.filter("state", pl_state)
+        if state_changed and origin is not None:
+            self.logger.debug(f"Suppressed play state echo of {origin}")
+            state_changed = False
+
+        self._debounce_seek(t_keeper, time)
+
+        if state_changed:
+            self.connection_handler.send_command(
+                Opcode.PLAY if pl_state else Opcode.PAUSE, int(time * 1000)
+            )
+            self._transition(
+                PlayerState.PLAYING if pl_state else PlayerState.PAUSED
+            )
+
+        self.scheduler.observe(
+            time, self.playing, vlc_status.get("rate", 1.0),
+            surprising=t_keeper is not None or state_changed
+        )
+
+        if state_changed and not pl_state:
+            self.drift.reset()
+            self._set_rate(1.0)
+
+        self._beacon(time)
+
+    def _debounce_seek(self, t_keeper, time):
+        # Scrubbing shows up as a run of seeks, only the final position
+        # is broadcast once the seek bar has been left alone
+        now = self.clock()
+        if t_keeper is not None:
+            self.pending_seek = now
+            return
+
+        if (
+            self.pending_seek is not None and
+            now - self.pending_seek >= self.SEEK_DEBOUNCE
+        ):
+            self.pending_seek = None
+            self.connection_handler.send_command(
+                Opcode.SEEK, int(time * 1000)
+            )
+
+    def _time_keeper(self, time=None):
+        if time is None:
+            self.scheduler.reset()
+            return
+
+        expected = self.scheduler.predict()
+        if expected is None:
+            return
+
+        diff = abs(time - expected)
+        self.logger.debug_every(
+            self.LOG_INTERVAL, "diff=%.3f | expected=%.3f", diff, expected
+        )
+
+        if diff <= self.DIFF_THRESHOLD:
+            return
+
+        return time
+
     def _validate(self):
         if os.name == "nt":
             if os.path.exists(self.vlcdir):
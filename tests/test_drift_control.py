@@ -0,0 +1,263 @@
+import heapq
+import itertools
+import logging
+
+from scripts.com_packet import CommPacket
+from scripts.drift_control import ClsDriftController
+from scripts.protocol import ClsDispatcher, to_text, is_for_vlc
+from scripts.poll_scheduler import ClsPollScheduler
+from scripts.vlc_util import ClsVLCUtil, PlayerState
+
+STEP = 0.05
+LENGTH = 7200
+STABLE_INTERVAL = ClsPollScheduler.STABLE_INTERVAL
+
+logging.getLogger('VLCync').setLevel(logging.WARNING)
+
+
+class ClsFakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class _ServerClock:
+    # All peers share a perfectly synchronised server clock, in ms
+    def __init__(self, clock):
+        self.clock = clock
+
+    def now(self):
+        return int(self.clock() * 1000)
+
+    def one_way_delay(self, sent_at):
+        if sent_at is None:
+            return 0
+        return max(0, self.now() - sent_at)
+
+
+class _Config:
+    def get_value(self, section, option, default=None):
+        return default
+
+
+class ClsSimNetwork:
+    def __init__(self, clock):
+        self.clock = clock
+        self.peers = {}
+        self.in_flight = []
+        self.order = itertools.count()
+
+    def send(self, sender, opcode, args):
+        seq = next(self.order)
+        source = self.peers[sender]
+        for username, peer in self.peers.items():
+            if peer is source:
+                continue
+
+            packet = CommPacket(
+                sender, to_text(opcode, *args), is_for_vlc(opcode),
+                int(opcode), args, source.connection_handler.clock.now(), seq
+            )
+            delay = source.latency + peer.latency
+            heapq.heappush(
+                self.in_flight, (self.clock() + delay, seq, username, packet)
+            )
+
+    def deliver(self):
+        while len(self.in_flight) and self.in_flight[0][0] <= self.clock():
+            _, _, username, packet = heapq.heappop(self.in_flight)
+            self.peers[username].dispatcher.dispatch(packet)
+
+
+class _Connection:
+    capabilities = {"BEACON": ""}
+
+    def __init__(self, network, username, clock):
+        self.network = network
+        self.username = username
+        self.clock = _ServerClock(clock)
+
+    def send_command(self, opcode, *args):
+        self.network.send(self.username, opcode, args)
+
+    def disconnect(self):
+        pass
+
+
+class ClsSimPlayer(ClsVLCUtil):
+    # The real actor, only its thread is left idle: the simulation runs
+    # _step() whenever it would not block
+    def __init__(self, network, username, position, latency, clock):
+        self.media_position = position
+        self.media_rate = 1.0
+        self.last_advance = clock()
+        self.latency = latency
+        self.polls = 0
+        self.seeks = 0
+        super().__init__(
+            _Config(), _Connection(network, username, clock), clock
+        )
+        self.dispatcher = ClsDispatcher()
+        self.register_handlers(self.dispatcher)
+        self.length = LENGTH
+        self.media = "sim.mkv"
+        self.state = PlayerState.PLAYING
+        self.scheduler.anchor(position, playing=True)
+        self.last_beacon = clock() - ClsVLCUtil.BEACON_INTERVAL * (
+            len(network.peers) / 4
+        )
+        network.peers[username] = self
+
+    def _run(self):
+        pass
+
+    def _launch(self, file_path):
+        pass
+
+    def advance(self):
+        now = self.clock()
+        self.media_position += (now - self.last_advance) * self.media_rate
+        self.last_advance = now
+
+    def _vlc_transceiver(self, query=None, **kwargs):
+        self.advance()
+        if query == "seek":
+            self.seeks += 1
+            self.media_position = float(kwargs["val"][:-1]) / 100 * LENGTH
+        elif query == "rate":
+            self.media_rate = float(kwargs["val"])
+        elif query is None:
+            self.polls += 1
+
+        return {
+            "state": "playing",
+            "time": int(self.media_position),
+            "length": LENGTH,
+            "position": self.media_position / LENGTH,
+            "rate": self.media_rate
+        }
+
+    def run_due(self):
+        while not self.inbox.empty() or self._next_timeout() == 0:
+            self._step()
+
+
+def simulate(positions, duration, latencies=None, noise=None):
+    # Each peer beacons, receives and applies its own drift controller
+    # through ClsVLCUtil. noise posts a no-op event to every inbox that
+    # often, like a busy lobby does
+    clock = ClsFakeClock()
+    network = ClsSimNetwork(clock)
+    latencies = latencies or [0.02] * len(positions)
+    peers = [
+        ClsSimPlayer(network, f"peer{index}", position, latency, clock)
+        for index, (position, latency) in enumerate(zip(positions, latencies))
+    ]
+
+    history = []
+    end = clock.now + duration
+    next_noise = clock.now
+    while clock.now < end:
+        clock.now += STEP
+        network.deliver()
+        if noise is not None and clock.now >= next_noise:
+            next_noise += noise
+            for peer in peers:
+                peer.post(lambda: None)
+
+        for peer in peers:
+            peer.run_due()
+            peer.advance()
+
+        history.append(
+            (clock.now, [peer.media_position for peer in peers])
+        )
+
+    return peers, history
+
+
+def spreads(history):
+    return [
+        (now, max(positions) - min(positions)) for now, positions in history
+    ]
+
+
+def converged_at(history, tolerance):
+    # Time from the start after which the spread stays within tolerance
+    start = history[0][0] - STEP
+    settled = None
+    for now, spread in spreads(history):
+        if spread > tolerance:
+            settled = None
+        elif settled is None:
+            settled = now - start
+    return settled
+
+
+def test_two_peers_converge():
+    peers, history = simulate([0.0, 1.0], 120)
+    settled = converged_at(history, 2 * ClsDriftController.DEADBAND)
+    assert settled is not None and settled < 45
+    # Both peers nudge towards each other between beacons, so the one
+    # that was behind may overtake, but by no more than twice the deadband
+    assert all(
+        behind - ahead <= 2 * ClsDriftController.DEADBAND
+        for _, (behind, ahead) in history
+    )
+    assert not any(peer.seeks for peer in peers)
+
+
+def test_lobby_converges_without_overshoot():
+    start = [0.0, 0.4, -0.5, 0.9]
+    peers, history = simulate(
+        start, 180, latencies=[0.01, 0.05, 0.12, 0.2]
+    )
+    settled = converged_at(history, 2 * ClsDriftController.DEADBAND)
+    assert settled is not None and settled < 90
+    # Nudging never drives the peers further apart than they started
+    initial = max(start) - min(start)
+    assert max(spread for _, spread in spreads(history)) <= initial + 1e-9
+    assert not any(peer.seeks for peer in peers)
+
+
+def test_far_behind_peer_seeks_then_converges():
+    peers, history = simulate([0.0, 0.2, -5.0], 120)
+    assert peers[2].seeks >= 1
+    assert not peers[0].seeks and not peers[1].seeks
+    settled = converged_at(history, 2 * ClsDriftController.DEADBAND)
+    assert settled is not None and settled < 45
+
+
+def test_busy_inbox_does_not_starve_polls():
+    duration = 30
+    peers, history = simulate([0.0, 1.0], duration, noise=0.4)
+    for peer in peers:
+        assert peer.polls >= 0.9 * duration / STABLE_INTERVAL
+    settled = converged_at(history, 2 * ClsDriftController.DEADBAND)
+    assert settled is not None
+
+
+def test_rate_is_bounded():
+    controller = ClsDriftController()
+    for drift in (-1.4, -0.5, -0.06, 0.06, 0.5, 1.4):
+        rate = controller.update(drift)
+        assert abs(rate - 1.0) <= ClsDriftController.MAX_NUDGE + 1e-9
+        # Ahead slows down, behind speeds up
+        assert (rate < 1.0) == (drift > 0)
+
+
+def test_deadband_holds_normal_speed():
+    controller = ClsDriftController()
+    controller.update(0.5)
+    assert controller.update(ClsDriftController.DEADBAND) == 1.0
+    assert controller.update(-ClsDriftController.DEADBAND) == 1.0
+
+
+def test_falls_back_to_seek_past_threshold():
+    controller = ClsDriftController(seek_threshold=1.0)
+    assert controller.update(-1.5) is None
+    assert controller.rate == 1.0
+    # The peer far ahead waits at normal speed for the others to jump
+    assert controller.update(1.5) == 1.0